@@ -0,0 +1,89 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_small_tree(root, files, dirs, size):
+    payload = os.urandom(size)
+    for d in range(dirs):
+        path = os.path.join(root, f"dir{d:04d}")
+        os.mkdir(path)
+        for f in range(files // dirs):
+            with open(os.path.join(path, f"file{f:06d}.bin"), "wb") as fh:
+                fh.write(payload)
+
+
+def make_huge_tree(root, files, size):
+    block = os.urandom(1024 * 1024)
+    for f in range(files):
+        with open(os.path.join(root, f"huge{f:02d}.bin"), "wb") as fh:
+            for _ in range(size // len(block)):
+                fh.write(block)
+
+
+def drop_copy(path):
+    shutil.rmtree(path)
+    os.sync()
+
+
+def time_copy(label, func, src, dst):
+    start = time.perf_counter()
+    func(src, dst)
+    elapsed = time.perf_counter() - start
+    drop_copy(dst)
+    print(f"  {label:24} {elapsed:8.3f} s")
+    return elapsed
+
+
+def run_case(name, src, scratch, thread_counts):
+    print(name)
+    dst = os.path.join(scratch, "copy")
+    time_copy("shutil.copytree", shutil.copytree, src, dst)
+    for threads in thread_counts:
+        pool = ThreadPoolExecutor(max_workers=threads)
+        try:
+            time_copy(f"fm.copy_tree threads={threads}",
+                      lambda s, d: fm.copy_tree(s, d, pool=pool), src, dst)
+        finally:
+            pool.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fm.copy_tree against shutil.copytree.")
+    parser.add_argument("--dir", help="Scratch directory (default: a new temporary directory).")
+    parser.add_argument("--small-files", type=int, default=20000)
+    parser.add_argument("--small-dirs", type=int, default=100)
+    parser.add_argument("--small-size", type=int, default=4096)
+    parser.add_argument("--huge-files", type=int, default=4)
+    parser.add_argument("--huge-size-mb", type=int, default=256)
+    parser.add_argument("--threads", default="1,4,8,16", help="Comma separated copy pool sizes.")
+    options = parser.parse_args()
+
+    global fm
+    import fm
+
+    scratch = tempfile.mkdtemp(prefix="fm-bench-copy-", dir=options.dir)
+    thread_counts = [int(n) for n in options.threads.split(",")]
+    try:
+        small = os.path.join(scratch, "small")
+        os.mkdir(small)
+        make_small_tree(small, options.small_files, options.small_dirs, options.small_size)
+        run_case(f"{options.small_files} files of {options.small_size} bytes", small, scratch, thread_counts)
+        shutil.rmtree(small)
+
+        huge = os.path.join(scratch, "huge")
+        os.mkdir(huge)
+        make_huge_tree(huge, options.huge_files, options.huge_size_mb * 1024 * 1024)
+        run_case(f"{options.huge_files} files of {options.huge_size_mb} MiB", huge, scratch, thread_counts)
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == "__main__":
+    main()
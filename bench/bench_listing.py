@@ -0,0 +1,166 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import urwid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class SyscallCounter:
+    def __init__(self):
+        self.counts = {}
+        self._originals = {}
+
+    def bump(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def wrap(self, name):
+        original = getattr(os, name)
+        self._originals[name] = original
+
+        def counted(*args, **kwargs):
+            self.bump(name)
+            return original(*args, **kwargs)
+
+        setattr(os, name, counted)
+
+    def wrap_scandir(self):
+        original = os.scandir
+        self._originals["scandir"] = original
+        counter = self
+
+        class CountingEntry:
+            def __init__(self, entry):
+                self._entry = entry
+                self.name = entry.name
+                self.path = entry.path
+
+            def is_dir(self, follow_symlinks=True):
+                # Free when readdir reported d_type, one stat() for symlinks.
+                if follow_symlinks and self._entry.is_symlink():
+                    counter.bump("stat")
+                return self._entry.is_dir(follow_symlinks=follow_symlinks)
+
+            def is_symlink(self):
+                return self._entry.is_symlink()
+
+            def stat(self, follow_symlinks=True):
+                counter.bump("stat" if follow_symlinks else "lstat")
+                return self._entry.stat(follow_symlinks=follow_symlinks)
+
+        class CountingIterator:
+            def __init__(self, it):
+                self._it = it
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                self._it.close()
+
+            def __iter__(self):
+                for entry in self._it:
+                    yield CountingEntry(entry)
+
+        def counted(path="."):
+            counter.bump("scandir")
+            return CountingIterator(original(path))
+
+        os.scandir = counted
+
+    def __enter__(self):
+        for name in ("stat", "lstat", "listdir"):
+            self.wrap(name)
+        self.wrap_scandir()
+        return self
+
+    def __exit__(self, *exc):
+        for name, original in self._originals.items():
+            setattr(os, name, original)
+
+
+def legacy_get_directory_contents(path):
+    # The listing as it was before the scandir engine: listdir, then two
+    # isdir() calls per entry.
+    items = os.listdir(path)
+    directories = []
+    files = []
+    for item in items:
+        if os.path.isdir(os.path.join(path, item)):
+            directories.append(item)
+        else:
+            files.append(item)
+    directories.sort()
+    files.sort()
+
+    contents = []
+    for item in directories + files:
+        item_path = os.path.join(path, item)
+        if os.path.isdir(item_path):
+            item_display = f"{fm.FOLDER_SYMBOL} {item}"
+        else:
+            item_display = f"  {item}"
+        if item_path in fm.selected_items:
+            contents.append(urwid.AttrMap(urwid.Text('* ' + item_display), 'selected', focus_map='selected_focus'))
+        else:
+            contents.append(urwid.AttrMap(urwid.Text(item_display), None, focus_map='reversed'))
+    return contents
+
+
+def fm_get_directory_contents(path):
+    return fm.EntryWalker(fm.get_directory_contents(path))
+
+
+def make_tree(root, files, dirs):
+    for i in range(dirs):
+        os.mkdir(os.path.join(root, f"dir{i:07d}"))
+    for i in range(files):
+        open(os.path.join(root, f"file{i:07d}.txt"), "w").close()
+
+
+def measure(func, path, repeat):
+    with SyscallCounter() as counter:
+        func(path)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return counter.counts, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the legacy listing against the scandir engine.")
+    parser.add_argument("path", nargs="?", help="Directory to list (default: a generated synthetic tree).")
+    parser.add_argument("--files", type=int, default=50000)
+    parser.add_argument("--dirs", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3)
+    options = parser.parse_args()
+
+    root = options.path
+    cleanup = None
+    if root is None:
+        cleanup = tempfile.mkdtemp(prefix="fm-bench-")
+        root = cleanup
+        make_tree(root, options.files, options.dirs)
+
+    global fm
+    import fm
+
+    try:
+        for label, func in (("legacy", legacy_get_directory_contents), ("scandir", fm_get_directory_contents)):
+            counts, best = measure(func, root, options.repeat)
+            syscalls = ", ".join(f"{name}={count}" for name, count in sorted(counts.items()))
+            print(f"{label:8} {best * 1000:9.1f} ms  {syscalls}")
+    finally:
+        if cleanup:
+            shutil.rmtree(cleanup)
+
+
+if __name__ == "__main__":
+    main()
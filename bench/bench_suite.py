@@ -0,0 +1,331 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import urwid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fm
+
+
+class FakeScreen(urwid.display.BaseScreen):
+    # Renders every frame like a terminal would, but keeps the output.
+    def __init__(self, cols=160, rows=50):
+        super().__init__()
+        self.size = (cols, rows)
+        self.frames = 0
+        self.last = None
+
+    def get_cols_rows(self):
+        return self.size
+
+    def draw_screen(self, size, canvas):
+        self.frames += 1
+        self.last = list(canvas.content())
+
+
+def make_flat_tree(root, count):
+    os.mkdir(root)
+    dirs = max(1, count // 100)
+    for i in range(dirs):
+        os.mkdir(os.path.join(root, f"dir{i:07d}"))
+    for i in range(count - dirs):
+        open(os.path.join(root, f"file{i:07d}.txt"), "w").close()
+
+
+def make_deep_tree(root, depth, files_per_level):
+    path = root
+    for level in range(depth):
+        path = os.path.join(path, f"level{level:03d}")
+        os.makedirs(path)
+        for i in range(files_per_level):
+            open(os.path.join(path, f"file{i:03d}.txt"), "w").close()
+
+
+def make_wide_tree(root, fanout, depth):
+    os.mkdir(root)
+    if depth == 0:
+        return
+    for i in range(fanout):
+        open(os.path.join(root, f"file{i}.txt"), "w").close()
+        make_wide_tree(os.path.join(root, f"dir{i}"), fanout, depth - 1)
+
+
+def make_mixed_tree(root, small_files, small_size, large_files, large_size):
+    os.mkdir(root)
+    payload = os.urandom(small_size)
+    for i in range(small_files):
+        subdir = os.path.join(root, f"small{i // 1000:03d}")
+        if i % 1000 == 0:
+            os.mkdir(subdir)
+        with open(os.path.join(subdir, f"file{i:06d}.bin"), "wb") as f:
+            f.write(payload)
+    block = os.urandom(1024 * 1024)
+    for i in range(large_files):
+        with open(os.path.join(root, f"large{i:02d}.bin"), "wb") as f:
+            for _ in range(large_size // len(block)):
+                f.write(block)
+
+
+def settle():
+    # Stands in for the event loop: finish the listing threads and run what
+    # they posted back.
+    while True:
+        loaders = [loader for loader in fm.directory_loaders if loader is not None]
+        for loader in loaders:
+            loader.join()
+        fm.run_main_loop_calls()
+        if not any(fm.directory_loaders):
+            return
+
+
+def draw():
+    fm.main_loop.draw_screen()
+
+
+class Suite:
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+
+    def measure(self, name, tree, func, prepare=None, repeat=None):
+        # Best of several timed runs, then one more run under tracemalloc
+        # for the peak of Python allocations.
+        times = []
+        for _ in range(repeat or self.repeat):
+            arg = prepare() if prepare else None
+            start = time.perf_counter()
+            func(arg) if prepare else func()
+            times.append(time.perf_counter() - start)
+        arg = prepare() if prepare else None
+        tracemalloc.start()
+        func(arg) if prepare else func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result = {"name": name, "tree": tree, "seconds": min(times), "mean_seconds": sum(times) / len(times),
+                  "runs": len(times), "peak_bytes": peak}
+        self.results.append(result)
+        print(f"{tree:>14} {name:32} {min(times) * 1000:10.2f} ms {peak / 1024 / 1024:9.2f} MiB",
+              file=sys.stderr)
+
+
+def open_directory(path):
+    fm.listing_cache.clear()
+    fm.update_directory(0, path)
+    settle()
+    draw()
+
+
+def bench_listing(suite, tree, path):
+    suite.measure("get_directory_contents", tree, lambda: fm.get_directory_contents(path))
+    suite.measure("update_directory", tree, lambda: open_directory(path))
+
+    def cached():
+        fm.update_directory(0, path)
+        settle()
+        draw()
+
+    open_directory(path)
+    suite.measure("update_directory_cached", tree, cached)
+
+    def select_all():
+        fm.toggle_select_all(0)
+        draw()
+
+    suite.measure("toggle_select_all", tree, select_all, repeat=suite.repeat * 2)
+    fm.clear_selected_items()
+
+    def jump():
+        fm.jump_to_opposite(0)
+        draw()
+
+    suite.measure("jump_to_opposite", tree, jump)
+
+    def keys(count):
+        fm.left_listbox.focus_position = 0
+        for _ in range(count):
+            fm.main_loop.process_input(["j"])
+            draw()
+
+    suite.measure("navigate_100_keys", tree, lambda: keys(100))
+
+    def held_keys():
+        fm.left_listbox.focus_position = 0
+        fm.main_loop._update(["j"] * 100, [])
+        draw()
+
+    suite.measure("navigate_100_keys_held", tree, held_keys)
+
+    def sort_modes():
+        for _ in fm.SORT_MODES:
+            fm.cycle_sort_mode(0)
+            draw()
+
+    suite.measure("cycle_sort_modes", tree, sort_modes, repeat=1)
+
+
+def run_job(job):
+    job.run()
+    fm.run_main_loop_calls()
+    if job.error:
+        raise job.error
+
+
+def bench_transfers(suite, tree, src, scratch):
+    dest = os.path.join(scratch, "dest")
+    os.mkdir(dest)
+    copied = os.path.join(dest, os.path.basename(src))
+
+    def fresh_dest():
+        if os.path.exists(copied):
+            shutil.rmtree(copied)
+
+    suite.measure("copy", tree, lambda _: run_job(fm.TransferJob("copy", [src], dest)), prepare=fresh_dest)
+
+    def move_there_and_back():
+        run_job(fm.TransferJob("move", [src], dest))
+        run_job(fm.TransferJob("move", [copied], os.path.dirname(src)))
+
+    fresh_dest()
+    suite.measure("move_same_device", tree, move_there_and_back)
+
+    def copy_for_delete():
+        fresh_dest()
+        run_job(fm.TransferJob("copy", [src], dest))
+        fm.update_directory(0, dest)
+        settle()
+        fm.clear_selected_items()
+        fm.selected_items.add(copied)
+
+    def delete(_):
+        fm.on_confirm_delete()
+        draw()
+
+    suite.measure("delete", tree, delete, prepare=copy_for_delete)
+
+    def purge(job):
+        fm.run_purge(job)
+        fm.run_main_loop_calls()
+
+    def delete_for_purge():
+        copy_for_delete()
+        fm.on_confirm_delete()
+        job = fm.trash_batches.pop()
+        fm.main_loop.remove_alarm(job.alarm)
+        job.alarm = None
+        return job
+
+    suite.measure("purge", tree, purge, prepare=delete_for_purge)
+    shutil.rmtree(dest)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(fm.__file__),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = {(r["tree"], r["name"]): r for r in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+    for result in new:
+        before = old.get((result["tree"], result["name"]))
+        if before is None:
+            continue
+        ratio = result["seconds"] / before["seconds"] if before["seconds"] else float("inf")
+        print(f"{result['tree']:>14} {result['name']:32} {before['seconds'] * 1000:10.2f} ms "
+              f"-> {result['seconds'] * 1000:10.2f} ms  x{ratio:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time fm's real code paths on synthetic trees, headlessly.")
+    parser.add_argument("--sizes", default="10000,100000",
+                        help="Comma separated entry counts of the flat directories (try 1000000 too).")
+    parser.add_argument("--deep", type=int, default=200, help="Depth of the deep tree.")
+    parser.add_argument("--wide", default="6,5", help="Fanout,depth of the wide tree.")
+    parser.add_argument("--small-files", type=int, default=5000)
+    parser.add_argument("--small-size", type=int, default=4096)
+    parser.add_argument("--large-files", type=int, default=3)
+    parser.add_argument("--large-size-mb", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--dir", help="Scratch directory (default: a new temporary directory).")
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout.")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="Print the timing ratios of two result files and exit.")
+    options = parser.parse_args()
+
+    if options.compare:
+        compare(*options.compare)
+        return
+
+    scratch = tempfile.mkdtemp(prefix="fm-bench-suite-", dir=options.dir)
+    fm.SESSION_PATH = os.path.join(scratch, "session")
+    fm.MAX_FPS = 0
+    fm.setup([scratch], screen=FakeScreen())
+    fm.load_deferred_pane()
+    settle()
+
+    suite = Suite(options.repeat)
+    try:
+        for size in (int(n) for n in options.sizes.split(",")):
+            path = os.path.join(scratch, f"flat{size}")
+            make_flat_tree(path, size)
+            bench_listing(suite, f"flat-{size}", path)
+            fm.update_directory(0, scratch)
+            settle()
+            fm.listing_cache.clear()
+            shutil.rmtree(path)
+
+        deep = os.path.join(scratch, "deep")
+        make_deep_tree(deep, options.deep, 10)
+        suite.measure("plan_tree", f"deep-{options.deep}", lambda: fm.plan_tree(deep))
+        bench_transfers(suite, f"deep-{options.deep}", deep, scratch)
+        shutil.rmtree(deep)
+
+        fanout, depth = (int(n) for n in options.wide.split(","))
+        wide = os.path.join(scratch, "wide")
+        make_wide_tree(wide, fanout, depth)
+        suite.measure("plan_tree", f"wide-{fanout}x{depth}", lambda: fm.plan_tree(wide))
+        bench_transfers(suite, f"wide-{fanout}x{depth}", wide, scratch)
+        shutil.rmtree(wide)
+
+        mixed = os.path.join(scratch, "mixed")
+        make_mixed_tree(mixed, options.small_files, options.small_size,
+                        options.large_files, options.large_size_mb * 1024 * 1024)
+        bench_transfers(suite, "mixed", mixed, scratch)
+    finally:
+        fm.update_directory(0, scratch)
+        settle()
+        shutil.rmtree(scratch)
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "options": vars(options),
+        "results": suite.results,
+    }
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fm
+from bench_suite import FakeScreen, settle
+
+
+class LiveScreen(FakeScreen):
+    # Lets the real event loop run without a terminal. On every frame it
+    # checks which churned names have reached the listing (or left it).
+    def __init__(self, probe):
+        super().__init__()
+        self.probe = probe
+
+    def hook_event_loop(self, event_loop, callback):
+        pass
+
+    def unhook_event_loop(self, event_loop):
+        pass
+
+    def draw_screen(self, size, canvas):
+        super().draw_screen(size, canvas)
+        self.probe.frame()
+
+
+class Churn(threading.Thread):
+    # Creates files at a steady rate, appends to a few and deletes each one
+    # once `keep` newer files exist, like a busy spool directory.
+    def __init__(self, root, rate, keep):
+        super().__init__(daemon=True)
+        self.root = root
+        self.rate = rate
+        self.keep = keep
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.created = {}
+        self.deleted = {}
+        self.count = 0
+
+    def run(self):
+        start = time.perf_counter()
+        alive = []
+        while not self.stopped.is_set():
+            due = int((time.perf_counter() - start) * self.rate)
+            while self.count < due:
+                name = f"churn{self.count:09d}.log"
+                with open(os.path.join(self.root, name), "w") as f:
+                    f.write("x")
+                with self.lock:
+                    self.created[name] = time.perf_counter()
+                alive.append(name)
+                if self.count % 10 == 0 and len(alive) > 1:
+                    with open(os.path.join(self.root, alive[-2]), "a") as f:
+                        f.write("more")
+                if len(alive) > self.keep:
+                    gone = alive.pop(0)
+                    os.unlink(os.path.join(self.root, gone))
+                    with self.lock:
+                        self.deleted[gone] = time.perf_counter()
+                self.count += 1
+            time.sleep(0.001)
+
+
+class Probe:
+    def __init__(self, churn):
+        self.churn = churn
+        self.appeared = []
+        self.vanished = []
+        self.frames = 0
+
+    def frame(self):
+        self.frames += 1
+        now = time.perf_counter()
+        names = fm.left_listbox.body.names()
+        with self.churn.lock:
+            for name in [name for name in self.churn.created if name in names]:
+                self.appeared.append(now - self.churn.created.pop(name))
+            for name in [name for name in self.churn.deleted if name not in names]:
+                self.vanished.append(now - self.churn.deleted.pop(name))
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    pick = lambda q: round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 2)
+    return {"count": len(samples), "p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99),
+            "max_ms": round(samples[-1] * 1000, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Churn a watched directory and measure how fast the pane follows.")
+    parser.add_argument("--files", type=int, default=100000, help="Files in the directory before the churn starts.")
+    parser.add_argument("--rate", type=int, default=2000, help="Files created (and later deleted) per second.")
+    parser.add_argument("--keep", type=int, default=5000, help="Churned files alive at any time.")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--key-interval", type=float, default=0.05,
+                        help="How often a j/k keypress is injected to measure input lag.")
+    parser.add_argument("--mode", choices=("live", "rescan"), default="live",
+                        help="live: the w watch mode; rescan: relist the directory every WATCH_INTERVAL instead.")
+    parser.add_argument("--dir", help="Scratch directory (default: a new temporary directory).")
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout.")
+    options = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix="fm-bench-watch-", dir=options.dir)
+    root = os.path.join(scratch, "spool")
+    os.mkdir(root)
+    for i in range(options.files):
+        open(os.path.join(root, f"file{i:07d}.txt"), "w").close()
+
+    fm.SESSION_PATH = os.path.join(scratch, "session")
+    churn = Churn(root, options.rate, options.keep)
+    probe = Probe(churn)
+    fm.setup([root], screen=LiveScreen(probe))
+    fm.load_deferred_pane()
+    settle()
+
+    key_lag = []
+    key_time = []
+    applied = []
+
+    def press(loop, due):
+        now = time.perf_counter()
+        key_lag.append(max(0.0, now - due))
+        fm.main_loop.process_input(['j' if len(key_lag) % 2 else 'k'])
+        key_time.append(time.perf_counter() - now)
+        fm.main_loop.set_alarm_in(options.key_interval, press, now + options.key_interval)
+
+    apply_watch_changes = fm.apply_watch_changes
+
+    def timed_apply(loop=None, data=None):
+        start = time.perf_counter()
+        apply_watch_changes(loop, data)
+        applied.append(time.perf_counter() - start)
+
+    fm.apply_watch_changes = timed_apply
+
+    def rescan(loop, data):
+        start = time.perf_counter()
+        fm.update_directory(0, root, record=False)
+        applied.append(time.perf_counter() - start)
+        if not churn.stopped.is_set():
+            fm.main_loop.set_alarm_in(fm.WATCH_INTERVAL, rescan)
+
+    def stop_churn(loop, data):
+        churn.stopped.set()
+        churn.join()
+        # Leave time for the last events to arrive and be applied.
+        fm.main_loop.set_alarm_in(max(1.0, 5 * fm.WATCH_INTERVAL), fm.stop_main_loop)
+
+    if options.mode == "live":
+        fm.toggle_watch_mode()
+    else:
+        fm.main_loop.set_alarm_in(fm.WATCH_INTERVAL, rescan)
+    churn.start()
+    fm.main_loop.set_alarm_in(options.key_interval, press, time.perf_counter() + options.key_interval)
+    fm.main_loop.set_alarm_in(options.seconds, stop_churn)
+    try:
+        fm.main_loop.run()
+        settle()
+        shown = set(fm.left_listbox.body.names())
+        on_disk = set(os.listdir(root))
+        results = {
+            "mode": options.mode,
+            "files": options.files,
+            "rate": options.rate,
+            "seconds": options.seconds,
+            "created": churn.count,
+            "frames": probe.frames,
+            "updates": percentiles(applied),
+            "visible_after_create": percentiles(probe.appeared),
+            "gone_after_delete": percentiles(probe.vanished),
+            "key_lag": percentiles(key_lag),
+            "key_handling": percentiles(key_time),
+            "listing_matches_disk": shown == on_disk,
+            "missing": len(on_disk - shown),
+            "stale": len(shown - on_disk),
+        }
+    finally:
+        churn.stopped.set()
+        shutil.rmtree(scratch)
+
+    text = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
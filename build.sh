@@ -9,8 +9,10 @@ source venv/bin/activate
 # Install dependencies
 pip install -r requirements.txt
 
-# Compile the Python project with PyInstaller
-pyinstaller --onefile fm.py
+# Compile the Python project with PyInstaller. A one-folder build starts
+# faster than --onefile, which unpacks itself to a temporary directory on
+# every launch. Run it as dist/fm/fm.
+pyinstaller --onedir fm.py
 
 # Deactivate the virtual environment
 deactivate
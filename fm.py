@@ -1,39 +1,345 @@
+import time
+
+# Taken before the remaining imports so --startup-time includes them.
+START_TIME = time.perf_counter()
+
 import os
+import sys
+import errno
 import urwid
-import subprocess
 import argparse
+import subprocess
 import shutil
+import json
+import hashlib
+import mmap
+import fnmatch
+import operator
+import cProfile
+import threading
+import ctypes
+import fcntl
+import struct
+import queue
+import re
+import functools
+from bisect import bisect_left
+from stat import S_IMODE, S_ISDIR, S_ISLNK, S_ISREG
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+# zipfile and tarfile, with the compression modules they pull in, add ~25ms
+# to startup; load_archive_modules imports them once an archive is opened.
+zipfile = tarfile = None
 
 FOLDER_SYMBOL = "📁"
 DEFAULT_LEFT_PANE_PATH = os.path.expanduser("~")
 DEFAULT_RIGHT_PANE_PATH = os.path.expanduser("~")
+WIDGET_CACHE_SIZE = 512
+FIRST_BATCH_SIZE = 256
+MAX_BATCH_SIZE = 65536
+LOADING_SUFFIX = " loading…"
+LISTING_CACHE_SIZE = 64
+LISTING_CACHE_MAX_ENTRIES = 2000000
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+COPY_THREADS = int(os.environ.get("FM_COPY_THREADS", 8))
+FICLONE = 0x40049409
+TRASH_PREFIX = ".fm-trash-"
+# <time>-<pid>-<counter>, as make_trash_batch names them.
+TRASH_BATCH_NAME = re.compile(r"\d+-(\d+)-\d+")
+PURGE_DELAY = 10
+TRANSFER_WORKERS = 2
+BATCH_OPERATIONS = ("copy", "move", "delete", "sync")
+HASH_CHUNK_SIZE = 1024 * 1024
+STATUS_REFRESH_INTERVAL = 0.5
+PLAN_DEFAULT_RATE = 100 * 1024 * 1024
+PLAN_FILE_COST = 0.0005
+PLAN_LEARN_BYTES = 16 * 1024 * 1024
+PLAN_DIALOG_CONFLICTS = 5
+INDEX_PATH = os.path.expanduser("~/.cache/fm/file-index")
+INDEX_THREADS = 8
+FINDER_MAX_MATCHES = 50000
+FINDER_RESULTS = 200
+SIZE_CACHE_PATH = os.path.expanduser("~/.cache/fm/folder-sizes")
+SIZE_CACHE_MAX_ENTRIES = 500000
+HASH_CACHE_PATH = os.path.expanduser("~/.cache/fm/file-hashes")
+HASH_CACHE_MAX_ENTRIES = 1000000
+DUPLICATE_BLOCK_SIZE = 64 * 1024
+DUPLICATE_DIALOG_GROUPS = 100
+ARCHIVE_NAME = re.compile(r"\.(?:zip|jar|tar|tgz|tbz2?|txz|tar\.(?:gz|bz2|xz))(?=/|$)", re.IGNORECASE)
+ARCHIVE_INDEX_DIR = os.path.expanduser("~/.cache/fm/tar-index")
+ARCHIVE_CACHE_SIZE = 8
+ARCHIVE_PREVIEW_BYTES = 65536
+HISTORY_SIZE = 100
+FOCUS_MEMORY_SIZE = 2000
+SNAPSHOT_DIRS = 32
+SNAPSHOT_MAX_ENTRIES = 1000000
+SORT_MODES = ("name", "natural", "extension", "size", "mtime")
+NATURAL_SPLIT = re.compile(r"(\d+)")
+PREVIEW_DELAY = 0.1
+PREVIEW_SNIFF_BYTES = 8192
+MAX_FPS = float(os.environ.get("FM_MAX_FPS", 30))
+SESSION_PATH = os.path.expanduser("~/.cache/fm/session")
+PROFILE_DIR = os.path.expanduser("~/.cache/fm")
+HISTOGRAM_WINDOW = 1000
+INSTRUMENTED_SYSCALLS = ("stat", "lstat", "scandir", "listdir", "open", "rename", "unlink", "rmdir",
+                         "mkdir", "copy_file_range", "sendfile")
+NAVIGATION_KEYS = {'j': 1, 'down': 1, 'k': -1, 'up': -1}
+CONFLICT_LISTING_THRESHOLD = 64
+SELECTION_RULE = re.compile(r"(size|mtime)(<=|>=|<|>)(\d+(?:\.\d+)?)([a-zA-Z]?)$")
+SIZE_UNITS = {"": 1, "b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+AGE_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
 
-overwrite_confirmed = False
-copy_move_confirmed = False
-
-parser = argparse.ArgumentParser(description="A simple file manager.")
-parser.add_argument('path', nargs='?', default=DEFAULT_LEFT_PANE_PATH, help="Initial path for the left pane.")
-args = parser.parse_args()
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+INOTIFY_LISTING_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+                        | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+INOTIFY_WATCH_MASK = INOTIFY_LISTING_MASK | IN_MODIFY
+INOTIFY_EVENT = struct.Struct("iIII")
+WATCH_INTERVAL = 0.1
+WATCH_SUFFIX = " [live]"
 
 LAST_KEY = None
-LEFT_PANE_PATH = args.path
+LEFT_PANE_PATH = DEFAULT_LEFT_PANE_PATH
 RIGHT_PANE_PATH = DEFAULT_RIGHT_PANE_PATH
 
+class Selection:
+    # Selected names grouped by their directory. Selecting a whole listing
+    # is a set update on one directory, rows look names up only when they
+    # are built, and full paths are only joined when an operation asks.
+    def __init__(self):
+        self.directories = {}
+
+    def __len__(self):
+        return sum(len(names) for names in self.directories.values())
+
+    def __bool__(self):
+        return bool(self.directories)
+
+    def __iter__(self):
+        return iter(self.paths())
+
+    def paths(self):
+        paths = []
+        for directory, names in self.directories.items():
+            prefix = os.path.join(directory, "")
+            paths += [prefix + name for name in names]
+        return paths
+
+    def __contains__(self, path):
+        directory, name = os.path.split(os.path.normpath(path))
+        return name in self.directories.get(directory, ())
+
+    def names(self, directory):
+        return self.directories.get(directory, ())
+
+    def add(self, path):
+        directory, name = os.path.split(os.path.normpath(path))
+        self.add_names(directory, (name,))
+
+    def discard(self, path):
+        directory, name = os.path.split(os.path.normpath(path))
+        self.discard_names(directory, (name,))
+
+    def add_names(self, directory, names):
+        self.directories.setdefault(directory, set()).update(names)
+        if not self.directories[directory]:
+            del self.directories[directory]
+
+    def discard_names(self, directory, names):
+        selected = self.directories.get(directory)
+        if selected is not None:
+            selected.difference_update(names)
+            if not selected:
+                del self.directories[directory]
+
+    def copy(self):
+        selection = Selection()
+        selection.directories = {directory: set(names) for directory, names in self.directories.items()}
+        return selection
+
+    def clear(self):
+        self.directories.clear()
+
+selected_items = Selection()
+directory_loaders = [None, None]
+pending_focus = [None, None]
+pane_history = [[], []]
+history_index = [-1, -1]
+focus_memory = OrderedDict()
+snapshots = OrderedDict()
+snapshot_entries = [0]
+size_jobs = [None, None]
+
+main_loop_calls = queue.SimpleQueue()
+wakeup_fd = None
+instrument = None
+profiler = None
+status_note = None
+transfer_rates = {}
+pane_watcher = None
+watch_handle = None
+watch_alarm = None
+watch_overflow = False
+watch_changes = {}
+
+class Histogram:
+    # Power-of-two buckets of microseconds over the whole run, plus the most
+    # recent samples for percentiles.
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = {}
+        self.recent = deque(maxlen=HISTOGRAM_WINDOW)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        bucket = int(seconds * 1000000).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.recent.append(seconds)
+
+    def summary(self):
+        recent = sorted(self.recent)
+
+        def percentile(p):
+            return recent[min(len(recent) - 1, int(p * len(recent)))] * 1000 if recent else 0.0
+
+        return {
+            "count": self.count,
+            "total_ms": self.total * 1000,
+            "mean_ms": self.total * 1000 / self.count if self.count else 0.0,
+            "max_ms": self.max * 1000,
+            "recent_p50_ms": percentile(0.5),
+            "recent_p90_ms": percentile(0.9),
+            "recent_p99_ms": percentile(0.99),
+            "buckets_us": {f"<{1 << bucket}": n for bucket, n in sorted(self.buckets.items())},
+        }
 
-selected_items = set()
+class Instrumentation:
+    def __init__(self, path):
+        self.path = path
+        self.started = time.time()
+        self.histograms = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def wrap_syscalls(self):
+        # Counts calls made through the os module from any thread. Stats done
+        # by DirEntry objects are counted in scan_directory instead.
+        for name in INSTRUMENTED_SYSCALLS:
+            func = getattr(os, name, None)
+            if func is not None:
+                setattr(os, name, self.counted(f"os.{name}", func))
+
+    def counted(self, name, func):
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            self.count(name)
+            return func(*args, **kwargs)
+        return call
+
+    def dump(self):
+        with self.lock:
+            data = {
+                "started": self.started,
+                "seconds": time.time() - self.started,
+                "counts": dict(self.counts),
+                "histograms": {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+            }
+        with open(self.path, "w") as f:
+            json.dump(data, f, indent=2)
+
+class StageTimer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        instrument.record(self.name, time.perf_counter() - self.start)
+
+NO_TIMER = nullcontext()
+
+def timed(name):
+    if instrument is None:
+        return NO_TIMER
+    return StageTimer(name)
+
+def instrumented(name):
+    def decorate(func):
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            if instrument is None:
+                return func(*args, **kwargs)
+            with StageTimer(name):
+                return func(*args, **kwargs)
+        return call
+    return decorate
+
+def enable_instrumentation(path):
+    global instrument
+    instrument = Instrumentation(path)
+    instrument.wrap_syscalls()
+
+def toggle_profiler():
+    # cProfile only sees the thread it was enabled on, which is the main
+    # loop; worker threads show up in the instrumentation histograms.
+    global profiler, status_note
+    if profiler is None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        status_note = "profiling, F9 to stop"
+    else:
+        path = stop_profiler()
+        status_note = f"profile saved to {path}"
+    update_status()
+
+def stop_profiler():
+    global profiler
+    profiler.disable()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, time.strftime("profile-%Y%m%d-%H%M%S.prof"))
+    profiler.dump_stats(path)
+    profiler = None
+    return path
 
 def jump_to_opposite(pane):
     listbox = left_listbox if pane == 0 else right_listbox
-    current_item = listbox.body[listbox.focus_position].base_widget.text
-    is_current_folder = current_item.startswith(FOLDER_SYMBOL) or current_item.startswith(f"* {FOLDER_SYMBOL}")
-    
-    for i, item in enumerate(listbox.body):
-        item_text = item.base_widget.text
-        is_folder = item_text.startswith(FOLDER_SYMBOL) or item_text.startswith(f"* {FOLDER_SYMBOL}")
-        
-        if is_current_folder != is_folder:
-            listbox.focus_position = i
-            break
+    walker = listbox.body
+    first_file = walker.first_file()
+    if not walker.entries or first_file in (0, len(walker.entries)):
+        return
+    listbox.focus_position = first_file if walker.focus < first_file else 0
 
 def shorten_path(path):
     parts = path.split(os.sep)
@@ -43,26 +349,484 @@ def shorten_path(path):
     else:
         return path
 
-def copy_items(source_path, dest_path):
-    for item in selected_items:
+def pane_title(pane, path):
+    walker = (left_listbox if pane == 0 else right_listbox).body
+    live = WATCH_SUFFIX if pane_watcher is not None and os.path.normpath(path) in pane_watcher.watches else ""
+    return f"{shorten_path(path)}{walker.sort_label()}{live}"
+
+def cycle_sort_mode(pane):
+    walker = (left_listbox if pane == 0 else right_listbox).body
+    mode = SORT_MODES[(SORT_MODES.index(walker.sort_mode) + 1) % len(SORT_MODES)]
+    set_sort_mode(pane, mode, walker.reverse)
+
+def set_sort_mode(pane, mode, reverse):
+    listbox = left_listbox if pane == 0 else right_listbox
+    listbox.set_focus_pending = None
+    listbox.body.set_sort(mode, reverse)
+    update_pane_title(pane)
+
+def update_pane_title(pane):
+    pane_box = left_pane if pane == 0 else right_pane
+    title = pane_title(pane, LEFT_PANE_PATH if pane == 0 else RIGHT_PANE_PATH)
+    if directory_loaders[pane] is not None:
+        title += LOADING_SUFFIX
+    pane_box.set_title(title)
+
+class DirectoryChanges:
+    # Names added to or removed from each directory by a file operation, so
+    # the panes can be patched instead of relisted.
+    def __init__(self):
+        self.added = {}
+        self.removed = {}
+        self.renamed = {}
+
+    def add(self, path):
+        parent, name = os.path.split(os.path.normpath(path))
+        self.added.setdefault(parent, set()).add(name)
+
+    def remove(self, path):
+        parent, name = os.path.split(os.path.normpath(path))
+        self.removed.setdefault(parent, set()).add(name)
+
+    def rename(self, old_path, new_path):
+        self.remove(old_path)
+        self.add(new_path)
+        self.renamed[os.path.normpath(old_path)] = os.path.normpath(new_path)
+
+    def directories(self):
+        return set(self.added) | set(self.removed)
+
+class TransferCancelled(Exception):
+    pass
+
+class TransferJob:
+    def __init__(self, operation, items, dest_path, overwrite=False, checksum=False, prune=False, plan=None):
+        self.operation = operation
+        # A selection is turned into paths on the transfer thread.
+        self.items = items.copy() if isinstance(items, Selection) else list(items)
+        self.dest_path = dest_path
+        self.overwrite = overwrite
+        self.checksum = checksum
+        self.prune = prune
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.files_total = 0
+        self.files_done = 0
+        self.bytes_skipped = 0
+        self.files_skipped = 0
+        self.files_removed = 0
+        self.started = None
+        self.finished = False
+        self.cancelled = False
+        self.error = None
+        self.plans = {}
+        self.plan = plan
+        self.dest_dev = None
+        self.renames = []
+        self.conflicts = []
+        self.sizes = {}
+        self.unmeasured = 0
+        self.lock = threading.Lock()
+        self.running = threading.Event()
+        self.running.set()
+        self.paused_at = None
+        self.paused_total = 0.0
+        self.pool = None
+
+    @property
+    def paused(self):
+        return not self.running.is_set()
+
+    def pause(self):
+        if not self.paused:
+            self.paused_at = time.monotonic()
+            self.running.clear()
+
+    def resume(self):
+        if self.paused:
+            self.paused_total += time.monotonic() - self.paused_at
+            self.paused_at = None
+            self.running.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self.resume()
+
+    def run(self):
+        run_transfer(self)
+
+    def add_progress(self, nbytes=0, files=0):
+        with self.lock:
+            self.bytes_done += nbytes
+            self.files_done += files
+
+    def add_total(self, nbytes=0, files=0):
+        with self.lock:
+            self.bytes_total += nbytes
+            self.files_total += files
+
+    def add_skipped(self, nbytes=0, files=0):
+        with self.lock:
+            self.bytes_skipped += nbytes
+            self.files_skipped += files
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+    def checkpoint(self):
+        self.running.wait()
+        if self.cancelled:
+            raise TransferCancelled()
+
+    def active_time(self):
+        if self.started is None:
+            return 0.0
+        now = self.paused_at or time.monotonic()
+        return now - self.started - self.paused_total
+
+    def throughput(self):
+        elapsed = self.active_time()
+        return self.bytes_done / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        rate = self.throughput()
+        if not rate:
+            return None
+        return (self.bytes_total - self.bytes_done) / rate
+
+    def describe(self):
+        if self.started is None:
+            return f"{self.operation} {len(self.items)} item(s) queued"
+        text = (f"{self.operation} {self.files_done}/{self.files_total} files "
+                f"{format_size(self.bytes_done)}/{format_size(self.bytes_total)} "
+                f"{format_size(self.throughput())}/s")
+        eta = self.eta()
+        if eta is not None:
+            text += f" ETA {format_duration(eta)}"
+        if self.files_skipped:
+            text += f" ({self.files_skipped} unchanged)"
+        if self.paused:
+            text += " [paused]"
+        return text
+
+    def sync_summary(self):
+        text = (f"sync: {self.files_done} file(s) copied, {self.files_skipped} unchanged, "
+                f"{format_size(self.bytes_skipped)} not transferred")
+        if self.files_removed:
+            text += f", {self.files_removed} removed"
+        return text
+
+def format_size(size):
+    for unit in ("B", "K", "M", "G", "T"):
+        if size < 1024 or unit == "T":
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+def clone_file(infd, outfd):
+    # Reflink (btrfs, xfs, ...): the copy shares extents until either side
+    # is written. Filesystems that refused once are not asked again.
+    dev = os.fstat(outfd).st_dev
+    if dev in reflink_unsupported:
+        return False
+    try:
+        fcntl.ioctl(outfd, FICLONE, infd)
+        return True
+    except OSError as e:
+        if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS):
+            reflink_unsupported.add(dev)
+        return False
+
+def copy_file_data(infd, outfd, job=None):
+    # copy_file_range and sendfile keep the data in the kernel; plain
+    # read/write is the fallback for filesystems that refuse both.
+    if hasattr(os, "copy_file_range"):
+        method = "copy_file_range"
+    elif hasattr(os, "sendfile"):
+        method = "sendfile"
+    else:
+        method = "read"
+    offset = 0
+    while True:
+        if job is not None:
+            job.checkpoint()
+        try:
+            if method == "copy_file_range":
+                n = os.copy_file_range(infd, outfd, COPY_CHUNK_SIZE)
+            elif method == "sendfile":
+                n = os.sendfile(outfd, infd, offset, COPY_CHUNK_SIZE)
+            else:
+                data = os.read(infd, COPY_CHUNK_SIZE)
+                n = len(data)
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(outfd, view):]
+        except OSError as e:
+            if offset or method == "read" or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                                             errno.EOPNOTSUPP, errno.EBADF):
+                raise
+            method = "sendfile" if method == "copy_file_range" and hasattr(os, "sendfile") else "read"
+            continue
+        if not n:
+            break
+        offset += n
+        if job is not None:
+            job.add_progress(n)
+
+def copy_file(src, dst, job=None):
+    # O_NONBLOCK keeps open() from waiting on a FIFO; only regular files
+    # are copied.
+    try:
+        with open(os.open(src, os.O_RDONLY | os.O_NONBLOCK), 'rb') as fsrc:
+            if not S_ISREG(os.fstat(fsrc.fileno()).st_mode):
+                raise OSError(errno.EINVAL, "Not a regular file", src)
+            with open(dst, 'wb') as fdst:
+                if clone_file(fsrc.fileno(), fdst.fileno()):
+                    if job is not None:
+                        job.add_progress(os.fstat(fsrc.fileno()).st_size)
+                else:
+                    copy_file_data(fsrc.fileno(), fdst.fileno(), job)
+    except TransferCancelled:
+        os.remove(dst)
+        raise
+    shutil.copystat(src, dst)
+    if job is not None:
+        job.add_progress(files=1)
+
+def plan_tree(src, follow_symlinks=True):
+    # Walks the tree once. Directories are listed parents first; symlinks
+    # are followed the same way shutil.copytree(symlinks=False) does. A
+    # copy leaves FIFOs, sockets and devices out: there is no data to copy,
+    # and opening a FIFO blocks until something writes to it. For a move
+    # (follow_symlinks=False) links and those special files are listed with
+    # size 0, for copy_node to recreate.
+    dirs = [""]
+    files = []
+    stack = [""]
+    while stack:
+        rel = stack.pop()
+        with os.scandir(os.path.join(src, rel)) as it:
+            for entry in it:
+                entry_rel = os.path.join(rel, entry.name)
+                if entry.is_dir(follow_symlinks=follow_symlinks):
+                    dirs.append(entry_rel)
+                    stack.append(entry_rel)
+                else:
+                    try:
+                        stat = entry.stat(follow_symlinks=follow_symlinks)
+                    except OSError:
+                        files.append((entry_rel, 0))
+                        continue
+                    if S_ISREG(stat.st_mode):
+                        files.append((entry_rel, stat.st_size))
+                    elif not follow_symlinks:
+                        files.append((entry_rel, 0))
+    return dirs, files
+
+def get_copy_pool(job=None):
+    # A job gets threads of its own: pausing it parks its tasks in them,
+    # which must not hold up other jobs. Work outside a job shares a pool.
+    global copy_pool
+    if job is not None:
+        with job.lock:
+            if job.pool is None:
+                job.pool = ThreadPoolExecutor(max_workers=COPY_THREADS, thread_name_prefix="fm-copy")
+            return job.pool
+    if copy_pool is None:
+        copy_pool = ThreadPoolExecutor(max_workers=COPY_THREADS, thread_name_prefix="fm-copy")
+    return copy_pool
+
+def run_parallel(pool, func, calls, limit=COPY_THREADS * 4):
+    # Keeps at most `limit` calls queued on the pool instead of creating a
+    # future per item up front, and stops submitting after the first error.
+    slots = threading.BoundedSemaphore(limit)
+    errors = []
+
+    def finished(future):
+        if not future.cancelled() and future.exception() is not None:
+            errors.append(future.exception())
+        slots.release()
+
+    for args in calls:
+        slots.acquire()
+        if errors:
+            slots.release()
+            break
+        pool.submit(func, *args).add_done_callback(finished)
+    for _ in range(limit):
+        slots.acquire()
+    for _ in range(limit):
+        slots.release()
+    if errors:
+        raise errors[0]
+
+def copy_node(src, dst, job=None):
+    # For moves: a symlink is recreated as a link rather than copied
+    # through, as shutil.move does, and FIFOs, sockets and devices are
+    # recreated too. Where that is not allowed (device nodes need
+    # CAP_MKNOD) the move fails before anything is removed.
+    stat = os.lstat(src)
+    if S_ISREG(stat.st_mode):
+        copy_file(src, dst, job)
+        return
+    if S_ISLNK(stat.st_mode):
+        os.symlink(os.readlink(src), dst)
+    else:
+        os.mknod(dst, stat.st_mode, stat.st_rdev)
+    shutil.copystat(src, dst, follow_symlinks=False)
+    if job is not None:
+        job.add_progress(files=1)
+
+def copy_tree(src, dst, job=None, dirs_exist_ok=False, plan=None, pool=None, copy_function=copy_file):
+    dirs, files = plan if plan is not None else plan_tree(src)
+
+    os.makedirs(dst, exist_ok=dirs_exist_ok)
+    for rel in dirs[1:]:
+        try:
+            os.mkdir(os.path.join(dst, rel))
+        except FileExistsError:
+            if not dirs_exist_ok:
+                raise
+
+    # Largest files first so a few huge ones don't end up serialized at the
+    # tail.
+    files = sorted(files, key=lambda f: f[1], reverse=True)
+    run_parallel(pool or get_copy_pool(job), copy_function,
+                 ((os.path.join(src, rel), os.path.join(dst, rel), job) for rel, size in files))
+
+    for rel in reversed(dirs):
+        shutil.copystat(os.path.join(src, rel), os.path.join(dst, rel))
+
+def copy_path(src, dst, job=None, dirs_exist_ok=False):
+    if not os.path.lexists(src) and split_archive_path(src) is not None:
+        copy_archive_member(src, dst, job, dirs_exist_ok)
+    elif os.path.exists(dst) and os.path.samefile(src, dst):
+        # Opening the destination would truncate the source.
+        raise shutil.SameFileError(f"{src!r} and {dst!r} are the same file")
+    elif os.path.isdir(src):
+        plan = job.plans.get(src) if job is not None else None
+        copy_tree(src, dst, job, dirs_exist_ok, plan)
+    else:
+        copy_file(src, dst, job)
+
+def move_tree(src, dst, job=None):
+    # The tree is scanned when the move runs, not when it was planned, and
+    # only what was copied is removed: anything that appears in the source
+    # meanwhile is left there rather than deleted unseen.
+    dirs, files = plan = plan_tree(src, follow_symlinks=False)
+    copy_tree(src, dst, job, plan=plan, copy_function=copy_node)
+    for rel, size in files:
+        os.remove(os.path.join(src, rel))
+    left = 0
+    for rel in reversed(dirs):
+        try:
+            os.rmdir(os.path.join(src, rel))
+        except OSError as e:
+            if e.errno != errno.ENOTEMPTY:
+                raise
+            left += 1
+    if left:
+        raise OSError(errno.ENOTEMPTY, "Items added during the move were left in the source", src)
+
+def move_path(src, dst, job=None):
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # Unlike a copy, links stay links, inside the tree or as the item.
+        if os.path.isdir(src) and not os.path.islink(src):
+            move_tree(src, dst, job)
+        else:
+            copy_node(src, dst, job)
+            os.remove(src)
+
+def find_conflicts(items, dest_path):
+    # Large selections are checked against one listing of the destination
+    # instead of a stat per item.
+    if len(items) >= CONFLICT_LISTING_THRESHOLD:
+        try:
+            existing = set(os.listdir(dest_path))
+        except OSError:
+            pass
+        else:
+            if isinstance(items, Selection):
+                return [os.path.join(directory, name) for directory, names in items.directories.items()
+                        for name in names & existing]
+            return [item for item in items if os.path.basename(item) in existing]
+    return [item for item in items if os.path.lexists(os.path.join(dest_path, os.path.basename(item)))]
+
+def find_same(items, dest_path):
+    # Items that would land on themselves, because they are already in the
+    # destination directory.
+    try:
+        dest = os.stat(dest_path)
+    except (OSError, TypeError):
+        return []
+    if isinstance(items, Selection):
+        groups = items.directories.items()
+    else:
+        groups = {}
+        for item in items:
+            groups.setdefault(os.path.dirname(item), set()).add(os.path.basename(item))
+        groups = groups.items()
+    same = []
+    for directory, names in groups:
+        try:
+            if os.path.samestat(os.stat(directory), dest):
+                same.extend(os.path.join(directory, name) for name in names)
+        except OSError:
+            pass
+    return same
+
+def copy_items(items, dest_path, changes=None, job=None):
+    for item in items:
         dest_item = os.path.join(dest_path, os.path.basename(item))
         if os.path.exists(dest_item):
             raise FileExistsError(dest_item)
-        if os.path.isdir(item):
-            shutil.copytree(item, dest_item)
-        else:
-            shutil.copy2(item, dest_item)
+        if changes is not None:
+            changes.add(dest_item)
+        copy_path(item, dest_item, job)
 
-def move_items(source_path, dest_path):
-    for item in selected_items:
+def move_items(items, dest_path, changes=None, job=None):
+    for item in items:
         dest_item = os.path.join(dest_path, os.path.basename(item))
         if os.path.exists(dest_item):
             raise FileExistsError(dest_item)
-        shutil.move(item, dest_item)
+        try:
+            move_path(item, dest_item, job)
+        except BaseException:
+            if changes is not None and os.path.lexists(dest_item):
+                changes.add(dest_item)
+            raise
+        if changes is not None:
+            changes.rename(item, dest_item)
+
+def clear_selected_items():
+    selected_items.clear()
+    left_listbox.body.refresh()
+    right_listbox.body.refresh()
+
+def selection_in_archive():
+    return any(is_virtual(directory) for directory in selected_items.directories)
 
-def create_copy_move_dialog(operation):
-    text = urwid.Text(f"Are you sure you want to {operation} {len(selected_items)} item(s)?")
-    ok_button = urwid.Button("OK", on_press=lambda _: on_copy_move_confirm(True, operation))
+@instrumented("action.sync")
+def on_sync_confirm(plan, checksum, prune):
+    transfer_queue.submit(TransferJob("sync", plan.items, plan.dest_path, checksum=checksum, prune=prune))
+    clear_selected_items()
+    main_loop.widget = frame
+
+def create_error_dialog(error_message):
+    text = urwid.Text(f"An error occurred: {error_message}")
+    ok_button = urwid.Button("OK", on_press=lambda _: setattr(main_loop, 'widget', frame))
     
     dialog_body = [
         text,
@@ -72,174 +836,2269 @@ def create_copy_move_dialog(operation):
     dialog = NavigableDialog(dialog_body)
     
     return urwid.Overlay(
-        urwid.LineBox(dialog, title=f"Confirm {operation.capitalize()}"),
-        columns,
+        urwid.LineBox(dialog, title="Error"),
+        frame,
         align='center',
         valign='middle',
-        width=('relative', 30),
-        height=('relative', 20),
+        width=('relative', 50),
+        height=('relative', 30),
         min_width=20,
         min_height=5
     )
 
-def on_copy_move_confirm(confirmed, operation):
-    global copy_move_confirmed, selected_items
-    copy_move_confirmed = confirmed
-    main_loop.widget = columns
+def copy_items_force(items, dest_path, changes=None, job=None):
+    for item in items:
+        dest_item = os.path.join(dest_path, os.path.basename(item))
+        if changes is not None:
+            changes.add(dest_item)
+        copy_path(item, dest_item, job, dirs_exist_ok=True)
 
-    if confirmed:
-        source_path = LEFT_PANE_PATH if current_focus == 0 else RIGHT_PANE_PATH
-        dest_path = RIGHT_PANE_PATH if current_focus == 0 else LEFT_PANE_PATH
-        
+def move_items_force(items, dest_path, changes=None, job=None):
+    for item in items:
+        dest_item = os.path.join(dest_path, os.path.basename(item))
+        if os.path.lexists(dest_item):
+            if os.path.samestat(os.lstat(item), os.lstat(dest_item)):
+                # Discarding the destination would discard the source.
+                raise shutil.SameFileError(f"{item!r} and {dest_item!r} are the same file")
+            discard_path(dest_item)
         try:
-            if operation == "copy":
-                copy_items(source_path, dest_path)
-            elif operation == "move":
-                move_items(source_path, dest_path)
-        except FileExistsError:
-            main_loop.widget = create_overwrite_dialog(operation)
-            return
+            move_path(item, dest_item, job)
+        except BaseException:
+            if changes is not None:
+                changes.add(dest_item)
+            raise
+        if changes is not None:
+            changes.rename(item, dest_item)
 
-        update_directory(0, LEFT_PANE_PATH)
-        update_directory(1, RIGHT_PANE_PATH)
-        clear_selected_items()
+def scan_tree(root):
+    # Like plan_tree, but keeps the stat of every file for comparing.
+    dirs = {""}
+    files = {}
+    stack = [""]
+    while stack:
+        rel = stack.pop()
+        with os.scandir(os.path.join(root, rel)) as it:
+            for entry in it:
+                entry_rel = os.path.join(rel, entry.name)
+                try:
+                    if entry.is_dir():
+                        dirs.add(entry_rel)
+                        stack.append(entry_rel)
+                    else:
+                        files[entry_rel] = entry.stat()
+                except OSError:
+                    pass
+    return dirs, files
 
-def clear_selected_items():
-    global selected_items
-    selected_items.clear()
-    update_directory(0, LEFT_PANE_PATH)
-    update_directory(1, RIGHT_PANE_PATH)
-
-def confirm_overwrite(item):
-    main_loop.widget = create_overwrite_dialog(item)
-    main_loop.run()
-    return overwrite_confirmed
-
-def on_overwrite_confirm(confirmed, operation):
-    global main_loop
-    if confirmed:
-        source_path = LEFT_PANE_PATH if current_focus == 0 else RIGHT_PANE_PATH
-        dest_path = RIGHT_PANE_PATH if current_focus == 0 else LEFT_PANE_PATH
-        
+def file_digest(path, job=None):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while True:
+            if job is not None:
+                job.checkpoint()
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                return digest.digest()
+            digest.update(chunk)
+
+def same_file(src_stat, dst_stat):
+    # rsync's quick check: same size and the same mtime to the second.
+    return (src_stat.st_size == dst_stat.st_size
+            and src_stat.st_mtime_ns // 1000000000 == dst_stat.st_mtime_ns // 1000000000)
+
+def sync_files(pairs, job):
+    # (src, dst, src stat, dst stat or None); copies what differs and counts
+    # the rest as skipped. With job.checksum, same-sized files are compared
+    # by content, hashed in parallel, whatever their mtime.
+    changed = []
+    compare = []
+    for src, dst, src_stat, dst_stat in pairs:
+        if dst_stat is None:
+            changed.append((src, dst, src_stat.st_size))
+        elif job is not None and job.checksum and src_stat.st_size == dst_stat.st_size:
+            compare.append((src, dst, src_stat.st_size))
+        elif same_file(src_stat, dst_stat):
+            if job is not None:
+                job.add_skipped(src_stat.st_size, 1)
+        else:
+            changed.append((src, dst, src_stat.st_size))
+
+    def check(src, dst, size):
+        if file_digest(src, job) == file_digest(dst, job):
+            shutil.copystat(src, dst)
+            if job is not None:
+                job.add_skipped(size, 1)
+        else:
+            changed.append((src, dst, size))
+
+    run_parallel(get_copy_pool(job), check, compare)
+    if job is not None:
+        job.add_total(sum(size for src, dst, size in changed), len(changed))
+    changed.sort(key=lambda f: f[2], reverse=True)
+    run_parallel(get_copy_pool(job), copy_file, ((src, dst, job) for src, dst, size in changed))
+
+def prune_paths(paths, job=None):
+    if not paths:
+        return
+    originals = move_to_trash(paths)
+    if job is not None:
+        with job.lock:
+            job.files_removed += len(originals)
+    call_in_main_loop(schedule_purge, PurgeJob({item: None for item in originals}), 0)
+
+def sync_path(src, dst, job=None):
+    if not os.path.isdir(src):
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            prune_paths([dst], job)
+        try:
+            dst_stat = os.stat(dst)
+        except FileNotFoundError:
+            dst_stat = None
+        sync_files([(src, dst, os.stat(src), dst_stat)], job)
+        return
+
+    src_dirs, src_files = scan_tree(src)
+    if os.path.isdir(dst):
+        dst_dirs, dst_files = scan_tree(dst)
+    else:
+        if os.path.lexists(dst):
+            prune_paths([dst], job)
+        dst_dirs, dst_files = set(), {}
+
+    # Whatever is in the way of the other kind is removed first.
+    prune_paths([os.path.join(dst, rel) for rel in src_dirs & dst_files.keys()]
+                + [os.path.join(dst, rel) for rel in dst_dirs & src_files.keys()], job)
+    for rel in sorted(src_dirs - dst_dirs):
+        os.makedirs(os.path.join(dst, rel), exist_ok=True)
+    if job is not None and job.prune:
+        # Only the topmost extra path is removed; its contents go with it.
+        gone = dst_dirs - src_dirs
+        extra = [rel for rel in (gone - src_files.keys()) | (dst_files.keys() - src_files.keys() - src_dirs)
+                 if os.path.dirname(rel) not in gone]
+        prune_paths([os.path.join(dst, rel) for rel in extra], job)
+
+    sync_files([(os.path.join(src, rel), os.path.join(dst, rel), stat,
+                 dst_files.get(rel) if rel not in dst_dirs else None)
+                for rel, stat in src_files.items()], job)
+    for rel in sorted(src_dirs, reverse=True):
+        shutil.copystat(os.path.join(src, rel), os.path.join(dst, rel))
+
+def sync_items(items, dest_path, changes=None, job=None):
+    for item in items:
+        dest_item = os.path.join(dest_path, os.path.basename(item))
+        if changes is not None:
+            changes.add(dest_item)
+        sync_path(item, dest_item, job)
+
+TRANSFER_FUNCTIONS = {
+    ("copy", False): copy_items,
+    ("copy", True): copy_items_force,
+    ("move", False): move_items,
+    ("move", True): move_items_force,
+    ("sync", False): sync_items,
+    ("sync", True): sync_items,
+}
+
+def measure_transfer(job, operation=None, items=None):
+    operation = operation or job.operation
+    if operation == "sync":
+        # Only known once the trees are compared; sync_files adds it.
+        return
+    try:
+        job.dest_dev = os.stat(job.dest_path).st_dev
+    except (OSError, TypeError):
+        job.dest_dev = None
+    # Plain files are added to the totals in batches; one lstat each
+    # unless it is a symlink. Sizes are kept per item only for conflicts,
+    # which a transfer may skip.
+    conflicts = set(job.conflicts)
+    nbytes = files = 0
+    for item in job.items if items is None else items:
+        if job.cancelled:
+            raise TransferCancelled()
+        try:
+            stat = os.lstat(item)
+            if operation == "move" and stat.st_dev == job.dest_dev:
+                job.renames.append(item)
+                continue
+            if S_ISLNK(stat.st_mode) and operation != "move":
+                stat = os.stat(item)
+            if not S_ISDIR(stat.st_mode):
+                # A moved link is recreated, not copied through.
+                size = 0 if S_ISLNK(stat.st_mode) else stat.st_size
+                if item in conflicts:
+                    job.sizes[item] = (size, 1)
+                nbytes += size
+                files += 1
+                if files == 4096:
+                    job.add_total(nbytes, files)
+                    nbytes = files = 0
+                continue
+            plan = plan_tree(item, follow_symlinks=operation != "move")
+            if operation != "move":
+                job.plans[item] = plan
+            size = sum(size for rel, size in plan[1])
+            if item in conflicts:
+                job.sizes[item] = (size, len(plan[1]))
+            job.add_total(size, len(plan[1]))
+        except OSError:
+            # Archive members fail here and are counted as they are copied.
+            job.unmeasured += 1
+    job.add_total(nbytes, files)
+
+def use_plan(job):
+    # Takes the totals and trees from the plan the job was confirmed with,
+    # less the conflicts if those were skipped.
+    plan = job.plan
+    job.dest_dev = plan.dest_dev
+    # Moves scan their trees again as they run; see move_tree.
+    job.plans = plan.plans if job.operation == "copy" else {}
+    job.bytes_total = plan.bytes_total
+    job.files_total = plan.files_total
+    if len(job.items) < len(plan.items):
+        for item in plan.conflicts:
+            size, files = plan.sizes.get(item, (0, 0))
+            job.bytes_total -= size
+            job.files_total -= files
+
+def run_transfer(job):
+    job.started = time.monotonic()
+    transfer = TRANSFER_FUNCTIONS[(job.operation, job.overwrite)]
+    job.items = list(job.items)
+    with timed(f"transfer.{job.operation}"):
         try:
-            if operation == "copy":
-                copy_items_force(source_path, dest_path)
-            elif operation == "move":
-                move_items_force(source_path, dest_path)
-            update_directory(0, LEFT_PANE_PATH)
-            update_directory(1, RIGHT_PANE_PATH)
-            clear_selected_items()
+            if job.plan is not None:
+                use_plan(job)
+            else:
+                measure_transfer(job)
+            for item in job.items:
+                job.checkpoint()
+                changes = DirectoryChanges()
+                try:
+                    transfer([item], job.dest_path, changes, job)
+                finally:
+                    call_in_main_loop(apply_changes, changes)
+        except TransferCancelled:
+            pass
         except Exception as e:
-            error_dialog = create_error_dialog(str(e))
-            main_loop.widget = error_dialog
+            job.error = e
+    if instrument is not None:
+        instrument.count(f"transfer.{job.operation}.bytes", job.bytes_done)
+        instrument.count(f"transfer.{job.operation}.files", job.files_done)
+    job.finished = True
+    call_in_main_loop(on_transfer_finished, job)
+
+class PlanJob(TransferJob):
+    # Looks at a copy or move before it starts: one pass over the sources
+    # for sizes and file counts, one listing of the destination for
+    # conflicts, and which moves stay on one filesystem (a rename) or have to
+    # be copied. The transfer confirmed from it reuses the scanned trees.
+    def __init__(self, action, items, dest_path, listings=None):
+        super().__init__("plan", items, dest_path)
+        self.action = action
+        # Directory -> name -> Entry, for the panes' current listings.
+        self.listings = listings or {}
+        # Items already in the destination directory.
+        self.same = []
+
+    def run(self):
+        run_plan(self)
+
+    def estimate(self):
+        # Seconds, at the rate earlier transfers to this filesystem reached
+        # in this session, plus a fixed cost per file; renames are free.
+        if self.action == "delete":
+            return self.files_total * PLAN_FILE_COST
+        rate = transfer_rates.get(self.dest_dev, PLAN_DEFAULT_RATE)
+        return self.bytes_total / rate + self.files_total * PLAN_FILE_COST
+
+    def describe(self):
+        if self.started is None:
+            return f"plan {self.action} queued"
+        return f"planning {self.action}: {self.files_total} files {format_size(self.bytes_total)}"
+
+    def summary(self):
+        return {"files": self.files_total, "bytes": self.bytes_total, "renames": len(self.renames),
+                "conflicts": self.conflicts, "same": self.same, "unmeasured": self.unmeasured,
+                "estimate_seconds": round(self.estimate(), 3)}
+
+def plan_transfer(job):
+    if job.dest_path is not None:
+        job.conflicts = find_conflicts(job.items, job.dest_path)
+        if job.conflicts:
+            job.same = find_same(job.items, job.dest_path)
+    rest = measure_listed(job) if isinstance(job.items, Selection) and job.listings else None
+    job.items = list(job.items)
+    # A sync is sized as if every file had changed.
+    measure_transfer(job, "copy" if job.action == "sync" else job.action, rest)
+
+def measure_listed(job):
+    # Files a pane has listed are sized from their entries rather than a
+    # stat each; folders, and names the panes don't show, are left for
+    # measure_transfer.
+    try:
+        dest_dev = os.stat(job.dest_path).st_dev
+    except (OSError, TypeError):
+        dest_dev = None
+    conflicts = set(job.conflicts)
+    rest = []
+    nbytes = files = 0
+    for directory, names in job.items.directories.items():
+        listing = job.listings.get(directory)
+        try:
+            renamed = job.action == "move" and os.stat(directory).st_dev == dest_dev
+        except OSError:
+            listing = None
+        prefix = os.path.join(directory, "")
+        for name in names:
+            path = prefix + name
+            entry = listing.get(name) if listing is not None else None
+            if entry is None or entry.is_dir:
+                rest.append(path)
+            elif renamed:
+                job.renames.append(path)
+            else:
+                if path in conflicts:
+                    job.sizes[path] = (entry.size or 0, 1)
+                nbytes += entry.size or 0
+                files += 1
+    job.add_total(nbytes, files)
+    return rest
+
+def run_plan(job):
+    job.started = time.monotonic()
+    try:
+        with timed(f"plan.{job.action}"):
+            plan_transfer(job)
+        call_in_main_loop(on_plan_ready, job)
+    except TransferCancelled:
+        pass
+    except Exception as e:
+        job.error = e
+    job.finished = True
+    call_in_main_loop(on_transfer_finished, job)
+
+@instrumented("action.plan")
+def start_transfer_plan(operation):
+    dest_path = RIGHT_PANE_PATH if current_focus == 0 else LEFT_PANE_PATH
+    if is_virtual(dest_path) or (operation == "move" and selection_in_archive()):
+        main_loop.widget = create_error_dialog("Archives are read-only.")
+        return
+    listings = {}
+    for pane, walker in enumerate((left_listbox.body, right_listbox.body)):
+        if walker.directory in selected_items.directories and directory_loaders[pane] is None:
+            listings[walker.directory] = walker.names()
+    transfer_queue.start(PlanJob(operation, selected_items, dest_path, listings))
+
+def on_plan_ready(job):
+    if not job.cancelled:
+        main_loop.widget = create_plan_dialog(job)
+
+@instrumented("action.transfer")
+def on_plan_accept(plan, overwrite, skip_conflicts=False):
+    items = plan.items
+    if skip_conflicts:
+        conflicts = set(plan.conflicts)
+        items = [item for item in items if item not in conflicts]
+    if items:
+        transfer_queue.submit(TransferJob(plan.action, items, plan.dest_path, overwrite, plan=plan))
+    clear_selected_items()
+    main_loop.widget = frame
+
+def create_plan_dialog(job):
+    lines = [f"{job.action.capitalize()} {len(job.items)} item(s) to {shorten_path(job.dest_path)}"]
+    if job.files_total or not job.renames:
+        estimate = job.estimate()
+        lines.append(f"{job.files_total} file(s), {format_size(job.bytes_total)}, "
+                     + (f"about {format_duration(estimate)}" if estimate >= 1 else "under a second"))
+    if job.renames:
+        lines.append(f"{len(job.renames)} item(s) renamed in place (same filesystem)")
+    if job.action == "move" and len(job.renames) < len(job.items):
+        lines.append(f"{len(job.items) - len(job.renames)} item(s) copied across filesystems, then removed")
+    if job.unmeasured:
+        lines.append(f"{job.unmeasured} item(s) counted as they are copied")
+    if job.same:
+        names = ", ".join(os.path.basename(item) for item in job.same[:PLAN_DIALOG_CONFLICTS])
+        if len(job.same) > PLAN_DIALOG_CONFLICTS:
+            names += ", …"
+        lines.append(f"Error: source and destination are the same for {len(job.same)} item(s): {names}")
+    elif job.conflicts:
+        names = ", ".join(os.path.basename(item) for item in job.conflicts[:PLAN_DIALOG_CONFLICTS])
+        if len(job.conflicts) > PLAN_DIALOG_CONFLICTS:
+            names += ", …"
+        lines.append(f"{len(job.conflicts)} already exist: {names}")
+
+    choices = []
+    if not job.conflicts:
+        choices.append(("OK", lambda _: on_plan_accept(job, False)))
+    elif job.same:
+        # Nothing here may write to or remove the sources; only the items
+        # that are not in the way can go.
+        if len(job.conflicts) < len(job.items):
+            choices.append(("Skip existing", lambda _: on_plan_accept(job, False, skip_conflicts=True)))
+    else:
+        choices.append(("Overwrite", lambda _: on_plan_accept(job, True)))
+        if len(job.conflicts) < len(job.items):
+            choices.append(("Skip existing", lambda _: on_plan_accept(job, False, skip_conflicts=True)))
+        if job.action == "copy":
+            sync_choices = [
+                ("Sync changed (size, mtime)", False, False),
+                ("Sync changed (content)", True, False),
+                ("Mirror (also remove extra)", False, True),
+            ]
+            for label, checksum, prune in sync_choices:
+                choices.append((label, lambda _, c=checksum, p=prune: on_sync_confirm(job, c, p)))
+    choices.append(("Cancel", lambda _: setattr(main_loop, 'widget', frame)))
+
+    dialog_body = [urwid.Text("\n".join(lines)), urwid.Divider()]
+    for label, on_press in choices:
+        dialog_body.append(urwid.AttrMap(urwid.Button(label, on_press=on_press), None, focus_map='reversed'))
+    dialog = NavigableDialog(dialog_body)
+    dialog.listbox.set_focus(2)
+    return urwid.Overlay(
+        urwid.LineBox(dialog, title=f"Confirm {job.action.capitalize()}"),
+        frame,
+        align='center',
+        valign='middle',
+        width=('relative', 50),
+        height=('relative', 40),
+        min_width=20,
+        min_height=len(dialog_body) + 2
+    )
+
+class TransferQueue:
+    def __init__(self, workers=TRANSFER_WORKERS):
+        self.workers = workers
+        self.pending = queue.Queue()
+        self.jobs = []
+        self.threads = []
+
+    def submit(self, job):
+        self.jobs.append(job)
+        self.pending.put(job)
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        schedule_status_refresh()
+
+    def work(self):
+        while True:
+            job = self.pending.get()
+            if job.cancelled:
+                job.finished = True
+                call_in_main_loop(on_transfer_finished, job)
+                continue
+            self.run(job)
+
+    def run(self, job):
+        try:
+            job.run()
+        finally:
+            job.close_pool()
+
+    def start(self, job):
+        # Runs straight away on its own thread rather than behind queued
+        # transfers; for short jobs the user is waiting on.
+        self.jobs.append(job)
+        threading.Thread(target=self.run, args=(job,), daemon=True).start()
+        schedule_status_refresh()
+
+    def active_jobs(self):
+        return [job for job in self.jobs if not job.finished]
+
+def on_transfer_finished(job):
+    if job in transfer_queue.jobs:
+        transfer_queue.jobs.remove(job)
+    if job in trash_batches and not job.undoable_items():
+        trash_batches.remove(job)
+    if job.operation == "sync" and job.error is None and not job.cancelled:
+        global status_note
+        status_note = job.sync_summary()
+    if (job.operation in ("copy", "move") and job.error is None and not job.cancelled
+            and job.bytes_done >= PLAN_LEARN_BYTES and job.active_time() > 0):
+        rate = job.bytes_done / job.active_time()
+        previous = transfer_rates.get(job.dest_dev)
+        transfer_rates[job.dest_dev] = rate if previous is None else (previous + rate) / 2
+    update_status()
+    if job.error is not None:
+        main_loop.widget = create_error_dialog(str(job.error))
+
+@instrumented("action.cancel_transfer")
+def cancel_transfer():
+    jobs = transfer_queue.active_jobs()
+    if jobs:
+        jobs[0].cancel()
+        update_status()
+
+@instrumented("action.pause_transfer")
+def toggle_pause_transfer():
+    jobs = transfer_queue.active_jobs()
+    if jobs:
+        if jobs[0].paused:
+            jobs[0].resume()
+        else:
+            jobs[0].pause()
+        update_status()
+
+def update_status():
+    jobs = transfer_queue.active_jobs()
+    parts = []
+    if jobs:
+        text = jobs[0].describe()
+        if len(jobs) > 1:
+            text += f" (+{len(jobs) - 1} more)"
+        parts.append(text)
+    undoable = sum(len(job.undoable_items()) for job in trash_batches)
+    if undoable:
+        parts.append(f"{undoable} deleted item(s), u to undo")
+    if status_note:
+        parts.append(status_note)
+    status_bar.set_text("  |  ".join(parts))
+
+class PurgeJob(TransferJob):
+    # Deletes items that were already renamed into a trash directory.
+    # `originals` maps each trash path back to where it was deleted from,
+    # for undo; items the purger has not claimed yet can still be restored.
+    def __init__(self, originals):
+        super().__init__("delete", list(originals), None)
+        self.originals = originals
+        self.claimed = set()
+        self.undone = False
+        self.alarm = None
+
+    def run(self):
+        run_purge(self)
+
+    def undoable_items(self):
+        with self.lock:
+            if self.undone:
+                return []
+            return [item for item in self.items if item not in self.claimed and self.originals[item]]
+
+    def describe(self):
+        if self.started is None:
+            return f"delete {len(self.items)} item(s) queued"
+        text = f"delete {self.files_done}/{self.files_total} files"
+        if self.paused:
+            text += " [paused]"
+        return text
+
+def trash_directory(path):
+    # A trash directory on the same filesystem as `path`, so deleting is a
+    # rename. Tried at the mount point, under ~/.cache and next to the item.
+    dev = os.lstat(path).st_dev
+    trash = trash_dirs.get(dev)
+    if trash is not None:
+        return trash
+
+    parent = os.path.dirname(os.path.abspath(path))
+    mount = parent
+    while not os.path.ismount(mount):
+        mount = os.path.dirname(mount)
+    name = f"{TRASH_PREFIX}{os.getuid()}"
+    for root in (mount, os.path.expanduser("~/.cache"), parent):
+        candidate = os.path.join(root, name)
+        try:
+            os.makedirs(candidate, mode=0o700, exist_ok=True)
+            stat = os.lstat(candidate)
+        except OSError:
+            continue
+        # On a shared mount such as /tmp the name may already be taken by
+        # someone else, or be a symlink; only a private directory of ours
+        # is used.
+        if (not S_ISDIR(stat.st_mode) or stat.st_uid != os.getuid()
+                or S_IMODE(stat.st_mode) != 0o700 or stat.st_dev != dev):
+            continue
+        trash_dirs[dev] = candidate
+        purge_stale_trash(candidate)
+        return candidate
+    return None
+
+def make_trash_batch(path):
+    trash = trash_directory(path)
+    if trash is None:
+        return None
+    global trash_counter
+    trash_counter += 1
+    batch = os.path.join(trash, f"{int(time.time())}-{os.getpid()}-{trash_counter}")
+    os.mkdir(batch)
+    return batch
+
+def move_to_trash(paths):
+    # Returns {trash path: original path}; items that can't be renamed into a
+    # trash directory are purged in place and can't be undone.
+    originals = {}
+    batches = {}
+    for path in paths:
+        try:
+            dev = os.lstat(path).st_dev
+            if dev not in batches:
+                batches[dev] = make_trash_batch(path)
+            batch = batches[dev]
+            if batch is None:
+                raise OSError(errno.EXDEV, "no trash directory", path)
+            target = os.path.join(batch, str(len(originals)))
+            os.rename(path, target)
+            originals[target] = path
+        except OSError:
+            originals[path] = None
+    return originals
+
+def discard_path(path):
+    # Used from transfer threads; the purge itself is queued from the main loop.
+    originals = move_to_trash([path])
+    originals = {item: None for item in originals}
+    call_in_main_loop(schedule_purge, PurgeJob(originals), 0)
+
+def purge_stale_trash(trash):
+    # Batches left behind by a session that exited before its purge ran;
+    # batches of another running fm are left alone.
+    try:
+        names = os.listdir(trash)
+    except OSError:
+        return
+    stale = []
+    for name in names:
+        match = TRASH_BATCH_NAME.fullmatch(name)
+        if match is None:
+            continue
+        try:
+            pid = int(match.group(1))
+            if pid != os.getpid():
+                os.kill(pid, 0)
+                continue
+        except ProcessLookupError:
+            pass
+        except OSError:
+            continue
+        stale.append(os.path.join(trash, name))
+    if stale:
+        call_in_main_loop(schedule_purge, PurgeJob({path: None for path in stale}), 0)
+
+def plan_purge(path):
+    dirs = [path]
+    files = []
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                    stack.append(entry.path)
+                else:
+                    files.append(entry.path)
+    return dirs, files
+
+def unlink_file(path, job):
+    job.checkpoint()
+    os.unlink(path)
+    job.add_progress(files=1)
+
+@instrumented("transfer.purge")
+def run_purge(job):
+    job.started = time.monotonic()
+    try:
+        plans = {}
+        for item in job.items:
+            if os.path.isdir(item) and not os.path.islink(item):
+                plans[item] = plan_purge(item)
+                job.files_total += len(plans[item][1])
+            elif os.path.lexists(item):
+                job.files_total += 1
+        for item in job.items:
+            with job.lock:
+                if job.undone or job.cancelled:
+                    break
+                job.claimed.add(item)
+            if item in plans:
+                dirs, files = plans[item]
+                run_parallel(get_copy_pool(job), unlink_file, ((path, job) for path in files))
+                for path in reversed(dirs):
+                    os.rmdir(path)
+            elif os.path.lexists(item):
+                unlink_file(item, job)
+        trashes = set(trash_dirs.values())
+        for batch in set(os.path.dirname(item) for item in job.claimed):
+            if os.path.dirname(batch) not in trashes:
+                continue
+            try:
+                os.rmdir(batch)
+            except OSError:
+                pass
+    except TransferCancelled:
+        pass
+    except Exception as e:
+        job.error = e
+    job.finished = True
+    call_in_main_loop(on_transfer_finished, job)
+
+def schedule_purge(job, delay=PURGE_DELAY):
+    if any(job.originals.values()):
+        trash_batches.append(job)
+    if delay:
+        job.alarm = main_loop.set_alarm_in(delay, lambda loop, data: start_purge(job))
+        schedule_status_refresh()
+    else:
+        start_purge(job)
+    update_status()
+
+def purge_pending_trash():
+    # On exit: batches still waiting out PURGE_DELAY would otherwise stay on
+    # disk until a later delete on the same filesystem finds them.
+    for job in list(trash_batches):
+        if job.alarm is not None and not job.undone:
+            job.alarm = None
+            run_purge(job)
+            job.close_pool()
+
+def start_purge(job):
+    job.alarm = None
+    if not job.undone:
+        transfer_queue.submit(job)
+
+@instrumented("action.undo_delete")
+def undo_delete():
+    while trash_batches:
+        job = trash_batches.pop()
+        with job.lock:
+            restore = [item for item in job.items if item not in job.claimed and job.originals[item]]
+            job.undone = True
+        if job.alarm is not None:
+            main_loop.remove_alarm(job.alarm)
+            job.alarm = None
+        if not restore:
+            continue
+
+        changes = DirectoryChanges()
+        failed = []
+        for item in restore:
+            original = job.originals[item]
+            try:
+                if os.path.lexists(original):
+                    raise FileExistsError(original)
+                os.rename(item, original)
+                changes.add(original)
+            except OSError:
+                failed.append(original)
+        apply_changes(changes)
+        for batch in set(os.path.dirname(item) for item in restore):
+            try:
+                os.rmdir(batch)
+            except OSError:
+                pass
+        if failed:
+            main_loop.widget = create_error_dialog(f"Could not restore {', '.join(failed)}")
+        # Items that were purged in place were never undoable.
+        leftover = {item: None for item in job.items if item not in job.claimed and item not in restore}
+        if leftover:
+            schedule_purge(PurgeJob(leftover), 0)
+        update_status()
+        return
+
+def refresh_status(loop=None, user_data=None):
+    global status_alarm
+    status_alarm = None
+    update_status()
+    if transfer_queue.active_jobs() or trash_batches:
+        schedule_status_refresh()
+
+def schedule_status_refresh():
+    global status_alarm
+    if status_alarm is None:
+        status_alarm = main_loop.set_alarm_in(STATUS_REFRESH_INTERVAL, refresh_status)
+
+class Entry:
+    __slots__ = ("name", "path", "is_dir", "size", "mtime", "natural")
+
+    def __init__(self, name, path, is_dir, size=None, mtime=0.0):
+        self.name = name
+        self.path = path
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+        self.natural = None
+
+def scan_directory(path):
+    # One readdir pass; the type comes from d_type and each entry is lstat'ed
+    # exactly once, so nothing downstream has to go back to the filesystem.
+    # Entries are yielded unsorted in batches that double in size, so the
+    # first rows show up quickly and re-sorting stays O(n log n) overall.
+    batch = []
+    batch_size = FIRST_BATCH_SIZE
+    entries_seen = 0
+    try:
+        with os.scandir(path) as it:
+            for dir_entry in it:
+                if dir_entry.name.startswith(TRASH_PREFIX):
+                    continue
+                try:
+                    is_dir = dir_entry.is_dir()
+                    stat = dir_entry.stat(follow_symlinks=False)
+                    entry = Entry(dir_entry.name, dir_entry.path, is_dir,
+                                  None if is_dir else stat.st_size, stat.st_mtime)
+                except OSError:
+                    entry = Entry(dir_entry.name, dir_entry.path, False)
+                batch.append(entry)
+                entries_seen += 1
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+                    batch_size = min(batch_size * 2, MAX_BATCH_SIZE)
+    except PermissionError:
+        batch = [Entry("Permission denied", os.path.join(path, "Permission denied"), False)]
+    except FileNotFoundError:
+        batch = [Entry("Path not found", os.path.join(path, "Path not found"), False)]
+    if batch:
+        yield batch
+    if instrument is not None:
+        instrument.count("direntry.stat", entries_seen)
+
+def get_directory_contents(path):
+    entries = [entry for batch in scan_directory(path) for entry in batch]
+    entries.sort(key=entry_sort_key)
+    return entries
+
+def entry_sort_key(entry):
+    return (not entry.is_dir, entry.name)
+
+def natural_key(entry):
+    # Split once per entry, then reused by every natural or extension sort.
+    if entry.natural is None:
+        parts = NATURAL_SPLIT.split(entry.name.lower())
+        parts[1::2] = map(int, parts[1::2])
+        entry.natural = tuple(parts)
+    return entry.natural
+
+def natural_sort_key(entry):
+    return (not entry.is_dir, natural_key(entry), entry.name)
+
+def extension_sort_key(entry):
+    extension = os.path.splitext(entry.name)[1].lower() if not entry.is_dir else ""
+    return (not entry.is_dir, extension, natural_key(entry), entry.name)
+
+def size_sort_key(entry):
+    return (not entry.is_dir, -1 if entry.size is None else entry.size, entry.name)
+
+def mtime_sort_key(entry):
+    return (not entry.is_dir, entry.mtime, entry.name)
+
+SORT_KEYS = {
+    "name": entry_sort_key,
+    "natural": natural_sort_key,
+    "extension": extension_sort_key,
+    "size": size_sort_key,
+    "mtime": mtime_sort_key,
+}
+
+def make_entry(path):
+    try:
+        stat = os.lstat(path)
+    except OSError:
+        return None
+    is_dir = S_ISDIR(stat.st_mode) or (S_ISLNK(stat.st_mode) and os.path.isdir(path))
+    return Entry(os.path.basename(path), path, is_dir, None if is_dir else stat.st_size, stat.st_mtime)
+
+def directory_key(stat):
+    return (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}
+        self.watches = {}
+
+    def watch(self, path, mask=INOTIFY_LISTING_MASK):
+        wd = self.watches.get(path)
+        if wd is not None:
+            return wd
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            return None
+        self.paths[wd] = path
+        self.watches[path] = wd
+        return wd
+
+    def unwatch(self, path):
+        wd = self.watches.pop(path, None)
+        if wd is not None:
+            self.paths.pop(wd, None)
+            self._rm_watch(self.fd, wd)
+
+    def read_events(self):
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                path = self.paths.get(wd)
+                if mask & IN_IGNORED:
+                    self.paths.pop(wd, None)
+                    if path is not None and self.watches.get(path) == wd:
+                        del self.watches[path]
+                events.append((path, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+        self.paths.clear()
+        self.watches.clear()
+
+def open_inotify():
+    try:
+        return Inotify()
+    except (OSError, AttributeError):
+        return None
+
+class ListingCache:
+    # Listings keyed by path and validated against the directory's
+    # (dev, inode, mtime). With inotify a watched listing stays valid until an
+    # event invalidates it; otherwise every reuse is checked with one stat().
+    def __init__(self, inotify=None, max_dirs=LISTING_CACHE_SIZE, max_entries=LISTING_CACHE_MAX_ENTRIES):
+        self.inotify = inotify
+        self.max_dirs = max_dirs
+        self.max_entries = max_entries
+        self.listings = OrderedDict()
+        self.total_entries = 0
+
+    def get(self, path):
+        listing = self.listings.get(path)
+        if listing is not None:
+            self.listings.move_to_end(path)
+        return listing
+
+    def is_watched(self, path):
+        return self.inotify is not None and path in self.inotify.watches
+
+    def put(self, path, key, entries):
+        if key is None:
             return
+        self.invalidate(path)
+        if self.inotify is not None and self.inotify.watch(path) is not None:
+            # The listing was read after `key` was taken; anything that
+            # changed since then either moved the mtime or shows up as an
+            # event now that the watch is in place.
+            try:
+                if directory_key(os.stat(path)) != key:
+                    self.inotify.unwatch(path)
+                    return
+            except OSError:
+                self.inotify.unwatch(path)
+                return
+        self.listings[path] = (key, list(entries))
+        self.total_entries += len(entries)
+        while self.listings and (len(self.listings) > self.max_dirs or self.total_entries > self.max_entries):
+            self.invalidate(next(iter(self.listings)))
 
-    main_loop.widget = columns
-    
-def create_error_dialog(error_message):
-    text = urwid.Text(f"An error occurred: {error_message}")
-    ok_button = urwid.Button("OK", on_press=lambda _: setattr(main_loop, 'widget', columns))
-    
-    dialog_body = [
-        text,
+    def invalidate(self, path):
+        listing = self.listings.pop(path, None)
+        if listing is not None:
+            self.total_entries -= len(listing[1])
+        if self.inotify is not None:
+            self.inotify.unwatch(path)
+
+    def invalidate_tree(self, path):
+        prefix = path.rstrip(os.sep) + os.sep
+        for cached_path in [p for p in self.listings if p == path or p.startswith(prefix)]:
+            self.invalidate(cached_path)
+
+    def clear(self):
+        for path in list(self.listings):
+            self.invalidate(path)
+
+def process_inotify_events(data=None):
+    for path, mask, name in listing_cache.inotify.read_events():
+        if mask & IN_Q_OVERFLOW:
+            listing_cache.clear()
+        elif path is None:
+            continue
+        elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+            listing_cache.invalidate_tree(path)
+            drop_snapshot(path)
+        else:
+            listing_cache.invalidate(path)
+            drop_snapshot(path)
+            if mask & IN_ISDIR and mask & (IN_MOVED_FROM | IN_DELETE):
+                listing_cache.invalidate_tree(os.path.join(path, name))
+
+class ArchiveIndex:
+    # The members of one archive by directory, read on first use and kept
+    # while the archive's size and mtime stay the same. Paths inside an
+    # archive are the archive's own path followed by the member's name.
+    def __init__(self, path, stat):
+        self.path = path
+        self.key = (stat.st_size, stat.st_mtime_ns)
+        self.members = {}
+        self.children = {"": set()}
+
+    def add(self, name, is_dir, size, mtime, locator):
+        name = os.path.normpath(name.lstrip("/"))
+        if name == "." or name.startswith(".."):
+            return
+        self.members[name] = (is_dir, size, mtime, locator)
+        if is_dir:
+            self.children.setdefault(name, set())
+        # Parents without an entry of their own still show up.
+        parent, base = os.path.split(name)
+        while True:
+            siblings = self.children.setdefault(parent, set())
+            if base in siblings:
+                break
+            siblings.add(base)
+            if not parent or parent in self.members:
+                break
+            self.members[parent] = (True, None, mtime, None)
+            parent, base = os.path.split(parent)
+
+    def member(self, inner):
+        member = self.members.get(inner)
+        if member is None and inner:
+            raise FileNotFoundError(errno.ENOENT, "No such file or directory in archive", inner)
+        return member
+
+    def entries(self, inner):
+        member = self.member(inner)
+        if member is not None and not member[0]:
+            raise NotADirectoryError(errno.ENOTDIR, "Not a directory", inner)
+        prefix = os.path.join(self.path, inner)
+        entries = []
+        for name in self.children.get(inner, ()):
+            is_dir, size, mtime, locator = self.members[os.path.join(inner, name)]
+            entries.append(Entry(name, os.path.join(prefix, name), is_dir, None if is_dir else size, mtime))
+        return entries
+
+    def walk(self, inner):
+        # Files below a directory member as (inner name, size, mtime).
+        stack = [inner]
+        while stack:
+            directory = stack.pop()
+            for name in sorted(self.children.get(directory, ())):
+                child = os.path.join(directory, name)
+                is_dir, size, mtime, locator = self.members[child]
+                if is_dir:
+                    stack.append(child)
+                yield child, is_dir, size, mtime
+
+    def open_members(self, inners):
+        # (inner, reader) for several members in turn.
+        for inner in inners:
+            with self.open_member(inner) as reader:
+                yield inner, reader
+
+class ZipIndex(ArchiveIndex):
+    # The central directory is already an index, so nothing is cached.
+    def load(self):
+        with zipfile.ZipFile(self.path) as archive:
+            for info in archive.infolist():
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                self.add(info.filename, info.is_dir(), info.file_size, mtime, info.filename)
+
+    def open_member(self, inner):
+        archive = zipfile.ZipFile(self.path)
+        try:
+            return archive.open(self.member(inner)[3])
+        finally:
+            # The member keeps the file open until it is closed itself.
+            archive.close()
+
+    def open_members(self, inners):
+        with zipfile.ZipFile(self.path) as archive:
+            for inner in inners:
+                with archive.open(self.member(inner)[3]) as reader:
+                    yield inner, reader
+
+class TarMember:
+    # A bounded reader over the data of one tar member.
+    def __init__(self, archive, offset, size):
+        self.archive = archive
+        self.remaining = size
+        archive.fileobj.seek(offset)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.archive.fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class TarIndex(ArchiveIndex):
+    # Reading a tar's member table means walking every header, and through
+    # the whole stream if it is compressed, so the table with each member's
+    # data offset is saved under ARCHIVE_INDEX_DIR for the next time.
+    def cache_path(self):
+        return os.path.join(ARCHIVE_INDEX_DIR, hashlib.blake2b(self.path.encode(), digest_size=16).hexdigest())
+
+    def load(self):
+        try:
+            with open(self.cache_path()) as f:
+                data = json.load(f)
+            if data["path"] == self.path and tuple(data["key"]) == self.key:
+                for name, is_dir, size, mtime, offset in data["members"]:
+                    self.add(name, is_dir, size, mtime, offset)
+                return
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        members = []
+        with tarfile.open(self.path, "r:*") as archive:
+            for info in archive:
+                if info.isdir() or info.isreg():
+                    members.append((info.name, info.isdir(), info.size, info.mtime, info.offset_data))
+                    self.add(*members[-1])
+            # Members are not needed after the scan.
+            archive.members = []
+        try:
+            os.makedirs(ARCHIVE_INDEX_DIR, exist_ok=True)
+            temp = f"{self.cache_path()}.{os.getpid()}"
+            with open(temp, "w") as f:
+                json.dump({"path": self.path, "key": self.key, "members": members}, f, separators=(",", ":"))
+            os.replace(temp, self.cache_path())
+        except OSError:
+            pass
+
+    def open_member(self, inner):
+        is_dir, size, mtime, offset = self.member(inner)
+        # Plain tars seek straight to the data; compressed ones decompress
+        # up to it.
+        return TarMember(tarfile.open(self.path, "r:*"), offset, size)
+
+    def open_members(self, inners):
+        # One pass over one handle in offset order, so a compressed stream
+        # is decompressed once rather than up to every member again.
+        with tarfile.open(self.path, "r:*") as archive:
+            for inner in sorted(inners, key=lambda inner: self.member(inner)[3]):
+                is_dir, size, mtime, offset = self.member(inner)
+                yield inner, TarMember(archive, offset, size)
+
+def split_archive_path(path):
+    # (archive path, member name) for a path at or inside an archive file.
+    for match in ARCHIVE_NAME.finditer(path):
+        archive = path[:match.end()]
+        if os.path.isfile(archive):
+            inner = path[match.end():].strip("/")
+            return archive, os.path.normpath(inner) if inner else ""
+    return None
+
+def is_virtual(path):
+    return not os.path.isdir(path) and split_archive_path(path) is not None
+
+def load_archive_modules():
+    global zipfile, tarfile
+    if tarfile is None:
+        import zipfile
+        import tarfile
+
+def open_archive(path):
+    load_archive_modules()
+    stat = os.stat(path)
+    with archive_lock:
+        index = archive_indexes.get(path)
+        if index is not None and index.key == (stat.st_size, stat.st_mtime_ns):
+            archive_indexes.move_to_end(path)
+            return index
+    index = (ZipIndex if path.lower().endswith((".zip", ".jar")) else TarIndex)(path, stat)
+    index.load()
+    with archive_lock:
+        archive_indexes[path] = index
+        while len(archive_indexes) > ARCHIVE_CACHE_SIZE:
+            archive_indexes.popitem(last=False)
+    return index
+
+def list_archive(path):
+    archive, inner = split_archive_path(path)
+    return open_archive(archive).entries(inner)
+
+def copy_archive_member(src, dst, job=None, dirs_exist_ok=False):
+    # Streams members out; nothing else is extracted.
+    archive, inner = split_archive_path(src)
+    index = open_archive(archive)
+    is_dir, size, mtime, locator = index.member(inner) or (True, None, None, None)
+    if not is_dir:
+        if job is not None:
+            job.add_total(size, 1)
+        with index.open_member(inner) as fsrc:
+            copy_archive_data(fsrc, dst, mtime, job)
+        return
+
+    os.makedirs(dst, exist_ok=dirs_exist_ok)
+    files = {}
+    for name, member_is_dir, member_size, member_mtime in index.walk(inner):
+        target = os.path.join(dst, os.path.relpath(name, inner) if inner else name)
+        if member_is_dir:
+            os.makedirs(target, exist_ok=True)
+        else:
+            files[name] = (target, member_size, member_mtime)
+    if job is not None:
+        job.add_total(sum(size for target, size, mtime in files.values()), len(files))
+    for name, fsrc in index.open_members(files):
+        target, member_size, member_mtime = files[name]
+        copy_archive_data(fsrc, target, member_mtime, job)
+
+def copy_archive_data(fsrc, target, mtime, job=None):
+    if job is not None:
+        job.checkpoint()
+    with open(target, "wb") as fdst:
+        while True:
+            chunk = fsrc.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            fdst.write(chunk)
+            if job is not None:
+                job.add_progress(len(chunk))
+    os.utime(target, (mtime, mtime))
+    if job is not None:
+        job.add_progress(files=1)
+
+def walk_parallel(roots, visit, on_root_done=None, workers=INDEX_THREADS):
+    # visit(path, root) runs on a small thread pool and returns the
+    # subdirectories to descend into. on_root_done(root) is called from the
+    # worker that finishes the last directory below a root.
+    if not roots:
+        return
+    work = queue.SimpleQueue()
+    lock = threading.Lock()
+    remaining = {root: 1 for root in roots}
+    total = [len(remaining)]
+    for root in remaining:
+        work.put((root, root))
+
+    def worker():
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            path, root = item
+            subdirs = visit(path, root)
+            with lock:
+                remaining[root] += len(subdirs) - 1
+                root_done = remaining[root] == 0
+                total[0] += len(subdirs) - 1
+                finished = total[0] == 0
+            for subdir in subdirs:
+                work.put((subdir, root))
+            if root_done and on_root_done is not None:
+                on_root_done(root)
+            if finished:
+                for _ in range(workers):
+                    work.put(None)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+class FileIndex:
+    # On disk the index is one text file: a line holding an absolute
+    # directory path, a NUL and its mtime in nanoseconds, followed by one
+    # line per entry name, with a trailing slash on subdirectories. Names
+    # never contain a slash, so directory lines are the ones starting with
+    # one.
+
+    def __init__(self, roots, path=INDEX_PATH):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.path = path
+        self.dirs = {}
+        # (haystack, folded, count), built on the crawl thread and swapped
+        # in whole on the main loop.
+        self.paths = ("", "", 0)
+        self.crawling = False
+        self._last = None
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return
+        dirs = {}
+        names = None
+        for line in os.fsdecode(data).split("\n"):
+            if line.startswith("/"):
+                directory, _, mtime = line.partition("\0")
+                names = []
+                dirs[directory] = (int(mtime or 0), names)
+            elif line and names is not None:
+                names.append(line)
+        self.dirs = dirs
+
+    def save(self):
+        lines = []
+        for directory, (mtime, names) in self.dirs.items():
+            lines.append(f"{directory}\0{mtime}")
+            lines.extend(names)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp = f"{self.path}.{os.getpid()}"
+        with open(temp, "wb") as f:
+            f.write(os.fsencode("\n".join(lines)))
+        os.replace(temp, self.path)
+
+    def visit(self, path, dev, old, dirs):
+        stat = os.stat(path)
+        if stat.st_dev != dev:
+            return ()
+        mtime = stat.st_mtime_ns
+        known = old.get(path)
+        if known is not None and known[0] == mtime:
+            names = known[1]
+        else:
+            names = []
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.name.startswith(TRASH_PREFIX) or "\n" in entry.name:
+                        continue
+                    names.append(entry.name + "/" if entry.is_dir(follow_symlinks=False) else entry.name)
+            # A directory changed within the same clock tick as the listing
+            # could change again without a new mtime.
+            if time.time_ns() - mtime < 1000000000:
+                mtime = 0
+        dirs[path] = (mtime, names)
+        prefix = path if path.endswith("/") else path + "/"
+        return [prefix + name[:-1] for name in names if name.endswith("/")]
+
+    def crawl(self):
+        # Unchanged directories cost one stat; only those whose mtime moved
+        # are listed again.
+        old, dirs = self.dirs, {}
+        devs = {}
+        for root in self.roots:
+            try:
+                devs[root] = os.stat(root).st_dev
+            except OSError:
+                pass
+
+        def visit(path, root):
+            try:
+                return self.visit(path, devs[root], old, dirs)
+            except OSError:
+                return ()
+
+        walk_parallel(list(devs), visit)
+        self.dirs = dirs
+
+    def build(self):
+        paths = []
+        for directory, (mtime, names) in self.dirs.items():
+            prefix = directory if directory.endswith("/") else directory + "/"
+            paths.extend(prefix + name for name in names)
+        haystack = "\n".join(paths)
+        folded = haystack.lower()
+        if len(folded) != len(haystack):
+            # Case folding changed some lengths; offsets would not line up.
+            folded = None
+        return haystack, folded, len(paths)
+
+    def search(self, query, limit=FINDER_RESULTS):
+        # Runs on the finder worker. self.paths is read once, so a rebuild
+        # swapped in meanwhile only takes effect on the next search.
+        paths = self.paths
+        if not query:
+            return []
+        # Narrowing an earlier query only needs to rescan its matches.
+        haystack, folded, _ = paths
+        last = self._last
+        if last is not None and last[0] is paths and query.startswith(last[1]):
+            haystack, folded = last[2], last[3]
+        flags = 0
+        if query == query.lower():
+            if folded is not None:
+                text = folded
+            else:
+                text, flags = haystack, re.IGNORECASE
+        else:
+            text = haystack
+        # The first character is searched for literally; after it, possessive
+        # runs of "anything but the next character" find the leftmost
+        # subsequence match without backtracking.
+        pattern = re.compile(re.escape(query[0]) + "".join(
+            f"[^{re.escape(c)}\n]*+{re.escape(c)}" for c in query[1:]), flags)
+        matches = []
+        position = 0
+        while len(matches) < FINDER_MAX_MATCHES:
+            match = pattern.search(text, position)
+            if match is None:
+                break
+            start = text.rfind("\n", 0, match.start()) + 1
+            end = text.find("\n", match.end())
+            if end < 0:
+                end = len(text)
+            matches.append(haystack[start:end])
+            position = end + 1
+        # At the cap, the lines not scanned yet are kept after the matches
+        # so that narrowing still sees everything that could match.
+        joined = "\n".join(matches)
+        if len(matches) == FINDER_MAX_MATCHES and position < len(text):
+            joined += "\n" + haystack[position:]
+        self._last = (paths, query, joined, joined.lower() if folded is not None else None)
+        needle = query.lower() if query == query.lower() else query
+        return sorted(matches, key=lambda path: finder_rank(path, needle))[:limit]
+
+def finder_rank(path, needle):
+    name = os.path.basename(path.rstrip("/"))
+    if needle == needle.lower():
+        name = name.lower()
+    if needle in name:
+        return (0 if name.startswith(needle) else 1, len(name), len(path))
+    position = 0
+    for c in needle:
+        position = name.find(c, position) + 1
+        if not position:
+            return (3, len(path))
+    return (2, len(path))
+
+def index_file_tree(index):
+    if not index.dirs:
+        index.load()
+        call_in_main_loop(on_index_updated, index, index.build())
+    index.crawl()
+    paths = index.build()
+    index.crawling = False
+    call_in_main_loop(on_index_updated, index, paths)
+    try:
+        index.save()
+    except OSError:
+        pass
+
+def start_file_index():
+    global file_index
+    if file_index is None:
+        file_index = FileIndex(options.index_roots or [os.path.expanduser("~")])
+    if not file_index.crawling:
+        file_index.crawling = True
+        threading.Thread(target=index_file_tree, args=(file_index,), daemon=True).start()
+
+def on_index_updated(index, paths):
+    index.paths = paths
+    finder = getattr(main_loop.widget, "top_w", None)
+    if isinstance(finder, FinderDialog):
+        finder.update_results()
+
+class FinderWorker(threading.Thread):
+    # Searches off the event loop; as with previews, only the newest query
+    # is searched and older ones are dropped unread.
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.request = None
+        self.event = threading.Event()
+
+    def submit(self, request):
+        self.request = request
+        self.event.set()
+
+    def run(self):
+        while True:
+            self.event.wait()
+            self.event.clear()
+            request = self.request
+            index, query = request
+            call_in_main_loop(on_finder_results, request, index.search(query))
+
+def on_finder_results(request, paths):
+    finder = getattr(main_loop.widget, "top_w", None)
+    if request is finder_request and isinstance(finder, FinderDialog):
+        finder.show_results(paths)
+
+class SizeCache:
+    # Per directory, keyed by device and inode: its mtime, the bytes of its
+    # singly linked files, its hard linked files as (inode, size) pairs and
+    # the names of its subdirectories. A subtree total is rebuilt from these
+    # records with one stat per directory; only directories whose mtime
+    # moved are listed again.
+
+    def __init__(self, path=SIZE_CACHE_PATH, max_entries=SIZE_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.records = OrderedDict()
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        self.loaded = True
+        try:
+            with open(self.path) as f:
+                records = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            for key, record in records.items():
+                self.records.setdefault(key, record)
+
+    def save(self):
+        with self.lock:
+            while len(self.records) > self.max_entries:
+                self.records.popitem(last=False)
+            data = json.dumps(self.records, separators=(",", ":"))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp = f"{self.path}.{os.getpid()}"
+        with open(temp, "w") as f:
+            f.write(data)
+        os.replace(temp, self.path)
+
+    def lookup(self, stat):
+        key = f"{stat.st_dev}:{stat.st_ino}"
+        with self.lock:
+            record = self.records.get(key)
+            if record is not None and record[0] == stat.st_mtime_ns:
+                self.records.move_to_end(key)
+                return record
+        return None
+
+    def store(self, stat, record):
+        key = f"{stat.st_dev}:{stat.st_ino}"
+        with self.lock:
+            self.records[key] = record
+            self.records.move_to_end(key)
+
+class HashCache(SizeCache):
+    # Per file, keyed by device and inode: its mtime, its size and the hex
+    # digests of its first and last blocks and of its whole content, either
+    # None until needed.
+    def __init__(self, path=HASH_CACHE_PATH):
+        super().__init__(path, HASH_CACHE_MAX_ENTRIES)
+
+    def lookup(self, stat):
+        record = super().lookup(stat)
+        if record is not None and record[1] == stat.st_size:
+            return record
+        return None
+
+    def digest(self, path, stat, index, compute):
+        record = self.lookup(stat)
+        if record is None:
+            record = [stat.st_mtime_ns, stat.st_size, None, None]
+        if record[index] is None:
+            record = list(record)
+            record[index] = compute(path)
+            self.store(stat, record)
+        return record[index]
+
+def partial_digest(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        digest.update(f.read(DUPLICATE_BLOCK_SIZE))
+        size = os.fstat(f.fileno()).st_size
+        if size > DUPLICATE_BLOCK_SIZE:
+            f.seek(max(DUPLICATE_BLOCK_SIZE, size - DUPLICATE_BLOCK_SIZE))
+            digest.update(f.read(DUPLICATE_BLOCK_SIZE))
+    return digest.hexdigest()
+
+class DuplicateJob(TransferJob):
+    # Narrows a tree down to groups of identical files: by size, then by a
+    # hash of the first and last blocks, then by a hash of everything. Hard
+    # links to one inode count as one file since they share their blocks.
+    def __init__(self, root):
+        super().__init__("duplicates", [root], None)
+        self.stage = "scanning"
+        self.files = {}
+        self.groups = []
+
+    def run(self):
+        run_duplicate_scan(self)
+
+    def visit(self, path, root):
+        if self.cancelled:
+            return []
+        subdirs = []
+        found = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not entry.name.startswith(TRASH_PREFIX):
+                                subdirs.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            found.append((entry.path, entry.stat(follow_symlinks=False)))
+                    except OSError:
+                        pass
+        except OSError:
+            return []
+        with self.lock:
+            for path, stat in found:
+                if stat.st_size:
+                    self.files.setdefault((stat.st_dev, stat.st_ino), (path, stat))
+            self.files_total = len(self.files)
+        return subdirs
+
+    def narrow(self, groups, index, compute):
+        # Splits each group by one digest, computed on the copy pool.
+        digests = {}
+
+        def hash_file(path, stat):
+            self.checkpoint()
+            try:
+                digests[path] = hash_cache.digest(path, stat, index, compute)
+            except OSError:
+                pass
+            self.add_progress(stat.st_size if index == 3 else 0, 1)
+
+        calls = [(path, stat) for group in groups for path, stat in group]
+        with self.lock:
+            self.files_total = len(calls)
+            self.files_done = 0
+            self.bytes_total = sum(stat.st_size for path, stat in calls) if index == 3 else 0
+            self.bytes_done = 0
+        run_parallel(get_copy_pool(self), hash_file, calls)
+        narrowed = []
+        for group in groups:
+            by_digest = {}
+            for path, stat in group:
+                if path in digests:
+                    by_digest.setdefault(digests[path], []).append((path, stat))
+            narrowed.extend(same for same in by_digest.values() if len(same) > 1)
+        return narrowed
+
+    def wasted(self):
+        return sum(size * (len(paths) - 1) for size, paths in self.groups)
+
+    def describe(self):
+        if self.started is None:
+            return "find duplicates queued"
+        text = f"duplicates: {self.stage} {self.files_done}/{self.files_total} files"
+        if self.bytes_total:
+            text += f" {format_size(self.bytes_done)}/{format_size(self.bytes_total)}"
+        if self.paused:
+            text += " [paused]"
+        return text
+
+def run_duplicate_scan(job):
+    job.started = time.monotonic()
+    try:
+        if not hash_cache.loaded:
+            hash_cache.load()
+        walk_parallel(job.items, job.visit)
+        job.checkpoint()
+
+        by_size = {}
+        for path, stat in job.files.values():
+            by_size.setdefault(stat.st_size, []).append((path, stat))
+        groups = [group for group in by_size.values() if len(group) > 1]
+
+        job.stage = "comparing blocks"
+        groups = job.narrow(groups, 2, partial_digest)
+        # Files up to two blocks were read whole already.
+        small = [group for group in groups if group[0][1].st_size <= 2 * DUPLICATE_BLOCK_SIZE]
+        large = [group for group in groups if group[0][1].st_size > 2 * DUPLICATE_BLOCK_SIZE]
+        job.stage = "hashing"
+        groups = small + job.narrow(large, 3, lambda path: file_digest(path, job).hex())
+
+        job.groups = [(group[0][1].st_size, sorted(path for path, stat in group)) for group in groups]
+        job.groups.sort(key=lambda group: (-group[0] * (len(group[1]) - 1), group[1][0]))
+        call_in_main_loop(on_duplicates_found, job)
+    except TransferCancelled:
+        pass
+    except Exception as e:
+        job.error = e
+    try:
+        hash_cache.save()
+    except OSError:
+        pass
+    job.finished = True
+    call_in_main_loop(on_transfer_finished, job)
+
+def on_duplicates_found(job):
+    # The first path of every group is kept; the others are selected so a
+    # delete or move acts on them.
+    clear_selected_items()
+    for size, paths in job.groups:
+        for path in paths[1:]:
+            selected_items.add(path)
+    left_listbox.body.refresh()
+    right_listbox.body.refresh()
+    main_loop.widget = create_duplicates_dialog(job)
+
+def create_duplicates_dialog(job):
+    count = sum(len(paths) - 1 for size, paths in job.groups)
+    body = [
+        urwid.Text(f"{len(job.groups)} group(s) of identical files under {shorten_path(job.items[0])}\n"
+                   f"{count} duplicate(s) selected, {format_size(job.wasted())} reclaimable.\n"
+                   f"The first path of each group is kept; d deletes and m moves the rest."),
         urwid.Divider(),
-        urwid.AttrMap(ok_button, None, focus_map='reversed')
     ]
-    dialog = NavigableDialog(dialog_body)
-    
+    for size, paths in job.groups[:DUPLICATE_DIALOG_GROUPS]:
+        body.append(urwid.Text(f"{len(paths)}x {format_size(size):>7} {paths[0]}", wrap='clip'))
+    if len(job.groups) > DUPLICATE_DIALOG_GROUPS:
+        body.append(urwid.Text(f"… {len(job.groups) - DUPLICATE_DIALOG_GROUPS} more"))
+    ok_button = urwid.Button("OK", on_press=lambda _: setattr(main_loop, 'widget', frame))
+    body.extend([urwid.Divider(), urwid.AttrMap(ok_button, None, focus_map='reversed')])
+    dialog = NavigableDialog(body)
+    dialog.listbox.set_focus(len(body) - 1)
     return urwid.Overlay(
-        urwid.LineBox(dialog, title="Error"),
-        columns,
+        urwid.LineBox(dialog, title="Duplicates"),
+        frame,
         align='center',
         valign='middle',
-        width=('relative', 50),
-        height=('relative', 30),
+        width=('relative', 70),
+        height=('relative', 60),
         min_width=20,
-        min_height=5
+        min_height=9
     )
 
-def copy_items_force(source_path, dest_path):
-    for item in selected_items:
-        dest_item = os.path.join(dest_path, os.path.basename(item))
-        if os.path.isdir(item):
-            shutil.copytree(item, dest_item, dirs_exist_ok=True)
-        else:
-            shutil.copy2(item, dest_item)
+def list_directory_sizes(path):
+    files = 0
+    links = []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if stat.st_nlink > 1:
+                links.append((stat.st_ino, stat.st_size))
+            else:
+                files += stat.st_size
+    return files, links, subdirs
+
+class SizeJob:
+    # Cached records are trusted while their directory's mtime is unchanged,
+    # but a file growing in place does not move that mtime. A fresh job
+    # lists every directory again and replaces their records.
+    def __init__(self, pane, paths, fresh=False):
+        self.pane = pane
+        self.paths = paths
+        self.fresh = fresh
+        self.cancelled = False
+        self.totals = {}
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def visit(self, path, root):
+        if self.cancelled:
+            return ()
+        try:
+            stat = os.stat(path)
+            if stat.st_dev != self.devs[root]:
+                return ()
+            record = None if self.fresh else size_cache.lookup(stat)
+            if record is None:
+                files, links, subdirs = list_directory_sizes(path)
+                record = [stat.st_mtime_ns, files, links, subdirs]
+                if time.time_ns() - stat.st_mtime_ns >= 1000000000:
+                    size_cache.store(stat, record)
+        except OSError:
+            return ()
+        _, files, links, subdirs = record
+        with self.lock:
+            for ino, size in links:
+                if (root, stat.st_dev, ino) not in self.seen:
+                    self.seen.add((root, stat.st_dev, ino))
+                    files += size
+            self.totals[root] += files
+        return [os.path.join(path, name) for name in subdirs]
+
+    def on_root_done(self, root):
+        if not self.cancelled:
+            call_in_main_loop(on_folder_size, self, root, self.totals[root])
+
+    def run(self):
+        if not size_cache.loaded:
+            size_cache.load()
+        self.devs = {}
+        for path in self.paths:
+            try:
+                self.devs[path] = os.stat(path).st_dev
+                self.totals[path] = 0
+            except OSError:
+                pass
+        walk_parallel(list(self.devs), self.visit, self.on_root_done)
+        try:
+            size_cache.save()
+        except OSError:
+            pass
+
+def start_folder_sizes(pane):
+    # The first S in a directory answers from the cache; S again recounts
+    # its folders from disk.
+    previous = size_jobs[pane]
+    if previous is not None:
+        previous.cancelled = True
+    walker = (left_listbox if pane == 0 else right_listbox).body
+    if is_virtual(LEFT_PANE_PATH if pane == 0 else RIGHT_PANE_PATH):
+        return
+    paths = [entry.path for entry in walker.entries[:walker.first_file()]]
+    job = SizeJob(pane, paths, fresh=previous is not None and previous.paths == paths)
+    size_jobs[pane] = job
+    threading.Thread(target=job.run, daemon=True).start()
+
+def on_folder_size(job, path, total):
+    parent, name = os.path.split(path)
+    for pane in (0, 1):
+        pane_path = LEFT_PANE_PATH if pane == 0 else RIGHT_PANE_PATH
+        if os.path.normpath(pane_path) != parent:
+            continue
+        walker = (left_listbox if pane == 0 else right_listbox).body
+        i = walker.find(name)
+        if i is not None and walker.entries[i].is_dir:
+            walker.entries[i].size = total
+            if walker.sort_mode == "size":
+                walker.reposition(i)
+            else:
+                walker.refresh_position(i)
+
+def preview_text(data, lines, width):
+    # Decodes only the lines that fit the pane; a long line is cut after a
+    # few bytes per visible column.
+    result = []
+    position = 0
+    limit = width * 4
+    while len(result) < lines and position < len(data):
+        end = data.find(b"\n", position, position + limit)
+        if end < 0:
+            end = min(position + limit, len(data))
+            # The rest of an overlong line is skipped within the sniffed
+            # window only; without a newline there the preview ends.
+            next_position = data.find(b"\n", end, end + PREVIEW_SNIFF_BYTES)
+            next_position = len(data) if next_position < 0 else next_position + 1
+        else:
+            next_position = end + 1
+        line = data[position:end].decode("utf-8", "replace").expandtabs(4)
+        result.append(line[:width])
+        position = next_position
+    return result
+
+def preview_hex(data, lines):
+    result = []
+    for offset in range(0, min(len(data), lines * 16), 16):
+        chunk = data[offset:offset + 16]
+        text = "".join(chr(b) if 32 <= b < 127 else "." for b in chunk)
+        result.append(f"{offset:08x}  {chunk.hex(' '):<47}  {text}")
+    return result
+
+def preview_gzip(data):
+    flags, mtime = data[3], struct.unpack_from("<I", data, 4)[0]
+    lines = ["gzip compressed data"]
+    if flags & 0x08:
+        # FNAME follows FEXTRA, which only has to be skipped when present.
+        position = 10
+        if flags & 0x04:
+            position += 2 + struct.unpack_from("<H", data, 10)[0]
+        end = data.find(b"\0", position, position + 4096)
+        if end > 0:
+            lines.append(f"original name: {data[position:end].decode('latin-1')}")
+    if mtime:
+        lines.append(f"modified: {time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime))}")
+    return lines
+
+def preview_zip(path, lines):
+    # None when it is not a readable zip after all.
+    load_archive_modules()
+    try:
+        with zipfile.ZipFile(path) as archive:
+            members = archive.infolist()
+    except (zipfile.BadZipFile, OSError):
+        return None
+    result = [f"zip archive, {len(members)} member(s)"]
+    for info in members[:lines - 1]:
+        result.append(f"{format_size(info.file_size):>8}  {info.filename}")
+    return result
+
+def preview_archive_member(path, lines, width):
+    archive, inner = split_archive_path(path)
+    index = open_archive(archive)
+    member = index.member(inner)
+    if member is None or member[0]:
+        return sorted(entry.name for entry in index.entries(inner))[:lines] or ["(empty directory)"]
+    if not member[1]:
+        return ["(empty file)"]
+    with index.open_member(inner) as f:
+        data = f.read(ARCHIVE_PREVIEW_BYTES)
+    if b"\0" in data[:PREVIEW_SNIFF_BYTES]:
+        return preview_hex(data, lines)
+    return preview_text(data, lines, width)
+
+def render_preview(path, lines, width):
+    try:
+        if not os.path.lexists(path) and split_archive_path(path) is not None:
+            return preview_archive_member(path, lines, width)
+        stat = os.stat(path)
+        if S_ISDIR(stat.st_mode):
+            names = []
+            with os.scandir(path) as it:
+                for entry in it:
+                    names.append(entry.name)
+                    if len(names) >= lines:
+                        break
+            return sorted(names) or ["(empty directory)"]
+        if not S_ISREG(stat.st_mode):
+            return ["(not a regular file)"]
+        if stat.st_size == 0:
+            return ["(empty file)"]
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                head = data[:PREVIEW_SNIFF_BYTES]
+                if head.startswith(b"\x1f\x8b") and len(head) >= 10:
+                    return preview_gzip(head)
+                if head.startswith(b"PK\x03\x04"):
+                    result = preview_zip(path, lines)
+                    if result is not None:
+                        return result
+                if b"\0" in head:
+                    return preview_hex(data, lines)
+                return preview_text(data, lines, width)
+    except Exception as e:
+        return [f"(cannot preview: {e})"]
+
+class PreviewWorker(threading.Thread):
+    # Only the newest request matters; older ones are dropped unread.
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.request = None
+        self.event = threading.Event()
+
+    def submit(self, request):
+        self.request = request
+        self.event.set()
+
+    def run(self):
+        while True:
+            self.event.wait()
+            self.event.clear()
+            request = self.request
+            path, lines, width = request
+            call_in_main_loop(on_preview_ready, request, render_preview(path, lines, width))
+
+def toggle_preview():
+    global preview_worker, preview_path
+    if preview_box in columns.widget_list:
+        columns.contents.remove((preview_box, columns.options()))
+        return
+    columns.contents.append((preview_box, columns.options()))
+    columns.focus_position = current_focus
+    if preview_worker is None:
+        preview_worker = PreviewWorker()
+        preview_worker.start()
+    preview_path = None
+    schedule_preview()
+
+def schedule_preview():
+    # Called after every key; holding j/k keeps pushing the alarm back so
+    # only the entry the cursor settles on is read.
+    global preview_alarm, preview_path
+    if preview_box not in columns.widget_list:
+        return
+    entry = (left_listbox if current_focus == 0 else right_listbox).body.focused_entry()
+    path = entry.path if entry is not None else None
+    if path == preview_path:
+        return
+    preview_path = path
+    if preview_alarm is not None:
+        main_loop.remove_alarm(preview_alarm)
+    preview_alarm = main_loop.set_alarm_in(PREVIEW_DELAY, request_preview)
+
+def request_preview(loop=None, data=None):
+    global preview_alarm, preview_request
+    preview_alarm = None
+    path = preview_path
+    if path is None:
+        preview_box.set_title("Preview")
+        preview_content.set_text("")
+        return
+    cols, rows = main_loop.screen.get_cols_rows()
+    request = (path, max(1, rows - 3), max(1, cols // 3 - 2))
+    preview_request = request
+    preview_worker.submit(request)
+
+def on_preview_ready(request, lines):
+    if request is not preview_request:
+        return
+    preview_box.set_title(os.path.basename(request[0]) or request[0])
+    preview_content.set_text("\n".join(lines))
+
+def create_entry_widget(entry, selected=False):
+    if entry.is_dir:
+        item_display = f"{FOLDER_SYMBOL} {entry.name}"
+    else:
+        item_display = f"  {entry.name}"
+    if selected:
+        item_display = '* ' + item_display
+    text = urwid.Text(item_display)
+    if entry.is_dir and entry.size is not None:
+        text = urwid.Columns([text, ('pack', urwid.Text(format_size(entry.size)))], dividechars=1)
+    if selected:
+        return urwid.AttrMap(text, 'selected', focus_map='selected_focus')
+    return urwid.AttrMap(text, None, focus_map='reversed')
+
+class EntryWalker(urwid.ListWalker):
+    # Holds only the Entry records; row widgets are built when the ListBox
+    # asks for a position and kept in a small LRU cache keyed by the entry,
+    # so re-sorting keeps the rows that were already built.
+    def __init__(self, entries=()):
+        self.entries = list(entries)
+        self.focus = 0
+        self.directory = None
+        self.key = None
+        self.sort_mode = "name"
+        self.reverse = False
+        self.sort_key = entry_sort_key
+        self._widgets = OrderedDict()
+        self._first_file = None
+        self._names = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, position):
+        if position < 0:
+            raise IndexError(position)
+        entry = self.entries[position]
+        widget = self._widgets.get(entry)
+        if widget is not None:
+            self._widgets.move_to_end(entry)
+            return widget
+        with timed("widget.build"):
+            widget = create_entry_widget(entry, entry.name in selected_items.names(self.directory))
+        self._widgets[entry] = widget
+        if len(self._widgets) > WIDGET_CACHE_SIZE:
+            self._widgets.popitem(last=False)
+        return widget
+
+    def set_focus(self, position):
+        # The ListBox may still hold a pending focus from before the entries
+        # were swapped underneath it, so clamp rather than raise.
+        self.focus = max(0, min(position, len(self.entries) - 1))
+        self._modified()
+
+    def next_position(self, position):
+        if position + 1 >= len(self.entries):
+            raise IndexError
+        return position + 1
+
+    def prev_position(self, position):
+        if position <= 0:
+            raise IndexError
+        return position - 1
+
+    def positions(self, reverse=False):
+        if reverse:
+            return range(len(self.entries) - 1, -1, -1)
+        return range(len(self.entries))
+
+    def focused_entry(self):
+        if not self.entries:
+            return None
+        return self.entries[self.focus]
+
+    def first_file(self):
+        # Directories sort first in every mode, so this is also the number of
+        # directories.
+        if self._first_file is None:
+            self._first_file = bisect_left(self.entries, True, key=lambda entry: not entry.is_dir)
+        return self._first_file
 
-def move_items_force(source_path, dest_path):
-    for item in selected_items:
-        dest_item = os.path.join(dest_path, os.path.basename(item))
-        if os.path.exists(dest_item):
-            if os.path.isdir(dest_item):
-                shutil.rmtree(dest_item)
+    def names(self):
+        # Name -> entry for the whole listing; also used as the set of names.
+        if self._names is None:
+            self._names = {entry.name: entry for entry in self.entries}
+        return self._names
+
+    def sort_label(self):
+        if self.sort_mode == "name" and not self.reverse:
+            return ""
+        return f" [{self.sort_mode}{' rev' if self.reverse else ''}]"
+
+    def changed(self):
+        self._first_file = None
+        self._modified()
+
+    def refresh_position(self, position):
+        self._widgets.pop(self.entries[position], None)
+        self._modified()
+
+    def sort_entries(self):
+        self.entries.sort(key=self.sort_key)
+        self._first_file = None
+        if self.reverse:
+            first_file = self.first_file()
+            directories, files = self.entries[:first_file], self.entries[first_file:]
+            directories.reverse()
+            files.reverse()
+            self.entries[:] = directories + files
+
+    def set_sort(self, mode, reverse):
+        # Only reorders the entries already in memory; keys come from the
+        # stat data gathered while listing.
+        focused = self.focused_entry()
+        self.sort_mode = mode
+        self.reverse = reverse
+        self.sort_key = SORT_KEYS[mode]
+        self.sort_entries()
+        if focused is not None:
+            self.focus = self.locate(self.sort_key(focused))
+        self.changed()
+
+    def locate(self, key):
+        # Index at which an entry with this sort key belongs.
+        if not self.reverse:
+            return bisect_left(self.entries, key, key=self.sort_key)
+        first_file = self.first_file()
+        lo, hi = (first_file, len(self.entries)) if key[0] else (0, first_file)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sort_key(self.entries[mid]) > key:
+                lo = mid + 1
             else:
-                os.remove(dest_item)
-        shutil.move(item, dest_item)
-
-def confirm_overwrite(item):
-    main_loop.widget = create_overwrite_dialog(item)
-    main_loop.run()
-    return overwrite_confirmed
-
-def create_text_widget(text, path, focus=False):
-    if path in selected_items:
-        return urwid.AttrMap(urwid.Text('* ' + text), 'selected', focus_map='selected_focus')
-    return urwid.AttrMap(urwid.Text(text), None, focus_map='reversed')
-
-def create_overwrite_dialog(operation):
-    text = urwid.Text(f"Some files already exist. Overwrite?")
-    ok_button = urwid.Button("OK", on_press=lambda _: on_overwrite_confirm(True, operation))
-    
-    dialog_body = [
-        text,
-        urwid.Divider(),
-        urwid.AttrMap(ok_button, None, focus_map='reversed')
-    ]
-    dialog = NavigableDialog(dialog_body)
-    
-    return urwid.Overlay(
-        urwid.LineBox(dialog, title="Confirm Overwrite"),
-        columns,
-        align='center',
-        valign='middle',
-        width=('relative', 30),
-        height=('relative', 20),
-        min_width=20,
-        min_height=5
-    )
+                hi = mid
+        return lo
 
-def get_directory_contents(path):
-    try:
-        items = os.listdir(path)
-    except PermissionError:
-        items = ["Permission denied"]
-    except FileNotFoundError:
-        items = ["Path not found"]
-    
-    directories = []
-    files = []
+    def add_entries(self, entries):
+        # Keeps the cursor on the same entry if the user already moved it.
+        focused = self.entries[self.focus] if self.focus else None
+        self.entries.extend(entries)
+        self.sort_entries()
+        self._names = None
+        if focused is not None:
+            self.focus = self.locate(self.sort_key(focused))
+        self.changed()
 
-    for item in items:
-        item_path = os.path.join(path, item)
-        if os.path.isdir(item_path):
-            directories.append(item)
-        else:
-            files.append(item)
-    
-    directories.sort()
-    files.sort()
-    sorted_items = directories + files
-
-    contents = []
-    for item in sorted_items:
-        item_path = os.path.join(path, item)
-        if os.path.isdir(item_path):
-            item_display = f"{FOLDER_SYMBOL} {item}"
+    def find(self, name):
+        entry = self.names().get(name)
+        if entry is None:
+            return None
+        i = self.locate(self.sort_key(entry))
+        if i < len(self.entries) and self.entries[i] is entry:
+            return i
+        return None
+
+    def remove_entry(self, name):
+        i = self.find(name)
+        if i is None:
+            return
+        del self._names[name]
+        del self.entries[i]
+        if i < self.focus or self.focus >= len(self.entries):
+            self.focus = max(0, self.focus - 1)
+        self.changed()
+
+    def insert_entry(self, entry):
+        i = self.find(entry.name)
+        focused = i is not None and i == self.focus
+        if i is not None:
+            self.remove_entry(entry.name)
+        self._first_file = None
+        i = self.locate(self.sort_key(entry))
+        self.entries.insert(i, entry)
+        self._names[entry.name] = entry
+        if focused:
+            self.focus = i
+        elif i <= self.focus and len(self.entries) > 1:
+            self.focus += 1
+        self.changed()
+        return i
+
+    def update_entries(self, names, entries):
+        # Removes `names` and inserts or replaces `entries` in one pass: the
+        # rows to drop and the insertion points are found by bisecting the
+        # current order, then the list is rebuilt from slices between them.
+        # Only the changed rows have their sort key computed.
+        focused = self.focused_entry()
+        index = self.names()
+        drop = []
+        for name in list(names) + [entry.name for entry in entries]:
+            i = self.find(name)
+            if i is not None:
+                drop.append(i)
+                self._widgets.pop(index.pop(name), None)
+        entries = sorted(entries, key=self.sort_key, reverse=self.reverse)
+        inserts = sorted(((self.locate(self.sort_key(entry)), self.sort_key(entry)[0], n)
+                          for n, entry in enumerate(entries)))
+        cuts = sorted([(i, 1, 0) for i in drop] + [(i, 0, rank) for rank, (i, group, n) in enumerate(inserts)])
+        old = self.entries
+        rebuilt = []
+        start = 0
+        for i, removed, rank in cuts:
+            rebuilt.extend(old[start:i])
+            if removed:
+                start = i + 1
+            else:
+                start = i
+                entry = entries[inserts[rank][2]]
+                rebuilt.append(entry)
+                index[entry.name] = entry
+        rebuilt.extend(old[start:])
+        self.entries = rebuilt
+        self._first_file = None
+        if focused is not None and rebuilt:
+            focused = index.get(focused.name, focused)
+            self.focus = min(self.locate(self.sort_key(focused)), len(rebuilt) - 1)
         else:
-            item_display = f"  {item}"
-        contents.append(create_text_widget(item_display, item_path))
-    
-    return contents
+            self.focus = 0
+        self.changed()
+
+    def reposition(self, i):
+        # The entry's sort key changed, for example when its folder size
+        # arrived.
+        entry = self.entries.pop(i)
+        self._first_file = None
+        focused = i == self.focus
+        if i < self.focus:
+            self.focus -= 1
+        j = self.locate(self.sort_key(entry))
+        self.entries.insert(j, entry)
+        if focused:
+            self.focus = j
+        elif j <= self.focus and len(self.entries) > 1:
+            self.focus += 1
+        self._widgets.pop(entry, None)
+        self.changed()
+
+    def set_entries(self, entries, key=None):
+        self.entries = entries
+        self.key = key
+        self.focus = 0
+        # Cached listings may have been sorted for another mode.
+        self.sort_entries()
+        self._names = None
+        self._widgets.clear()
+        self.changed()
+
+    def snapshot(self):
+        return DirectorySnapshot(self.key, self.entries, self._names, self.sort_mode, self.reverse, self.focus)
+
+    def restore(self, snapshot):
+        # The entries come back already sorted, with their name map.
+        self.entries = snapshot.entries
+        self.key = snapshot.key
+        self._names = snapshot.names
+        self._first_file = None
+        self._widgets.clear()
+        self.focus = min(snapshot.focus, max(0, len(self.entries) - 1))
+        if (snapshot.sort_mode, snapshot.reverse) != (self.sort_mode, self.reverse):
+            focused = self.focused_entry()
+            self.sort_entries()
+            if focused is not None:
+                self.focus = self.locate(self.sort_key(focused))
+        self.changed()
+
+    def refresh(self):
+        self._widgets.clear()
+        self._modified()
 
 def create_delete_dialog():
     selected_files_count = len(selected_items)
@@ -258,7 +3117,7 @@ def create_delete_dialog():
     
     return urwid.Overlay(
         urwid.LineBox(dialog, title="Confirm Delete"),
-        columns,
+        frame,
         align='center',
         valign='middle',
         width=('relative', 30),
@@ -267,8 +3126,55 @@ def create_delete_dialog():
         min_height=5
     )
 
+def request_quit():
+    # Transfer threads are daemons; quitting under them would leave
+    # half-written files behind.
+    jobs = transfer_queue.active_jobs()
+    if not jobs:
+        raise urwid.ExitMainLoop()
+    main_loop.widget = create_quit_dialog(len(jobs))
+
+def create_quit_dialog(count):
+    text = urwid.Text(f"{count} job(s) still running. Quit anyway? Copies, moves and syncs are cancelled "
+                      "and their partial files removed; deletes finish first.")
+    dialog_body = [
+        text,
+        urwid.Divider(),
+        urwid.AttrMap(urwid.Button("Quit", on_press=on_quit_confirm), None, focus_map='reversed'),
+        urwid.AttrMap(urwid.Button("Keep running", on_press=lambda _: setattr(main_loop, 'widget', frame)), None, focus_map='reversed'),
+    ]
+    dialog = NavigableDialog(dialog_body)
+    dialog.listbox.set_focus(3)
+    return urwid.Overlay(
+        urwid.LineBox(dialog, title="Confirm Quit"),
+        frame,
+        align='center',
+        valign='middle',
+        width=('relative', 50),
+        height=('relative', 30),
+        min_width=20,
+        min_height=len(dialog_body) + 4
+    )
+
+def on_quit_confirm(button=None):
+    for job in transfer_queue.active_jobs():
+        if isinstance(job, PurgeJob):
+            job.resume()
+        else:
+            job.cancel()
+    main_loop.widget = frame
+    quit_when_idle()
+
+def quit_when_idle(loop=None, data=None):
+    global status_note
+    if not transfer_queue.active_jobs():
+        raise urwid.ExitMainLoop()
+    status_note = "quitting once the running jobs have stopped"
+    update_status()
+    main_loop.set_alarm_in(STATUS_REFRESH_INTERVAL, quit_when_idle)
+
 def create_action_dialog():
-    action_items = ["Open in Terminal", "Open in Nvim", "Select/Deselect All"]
+    action_items = ["Open in Terminal", "Open in Nvim", "Select/Deselect All", "Find Duplicates", "Input Statistics"]
     action_widgets = []
     for action in action_items:
         button = urwid.Button(action, on_press=lambda b, a=action: on_action_select(a))
@@ -277,7 +3183,7 @@ def create_action_dialog():
     dialog = NavigableDialog(action_widgets)
     return urwid.Overlay(
         urwid.LineBox(dialog, title="Select Action"),
-        columns,
+        frame,
         align='center',
         valign='middle',
         width=('relative', 30),
@@ -286,35 +3192,39 @@ def create_action_dialog():
         min_height=8
     )
 
-import shutil
-
+@instrumented("action.delete")
 def on_confirm_delete(button=None):
-    global selected_items
     if not selected_items:
-        main_loop.widget = columns
+        main_loop.widget = frame
+        return
+    if selection_in_archive():
+        main_loop.widget = create_error_dialog("Archives are read-only.")
         return
 
+    # Renaming into the trash is instant; the actual unlinking happens in a
+    # background purge that can still be undone with `u` until it starts.
+    changes = DirectoryChanges()
+    originals = move_to_trash(selected_items)
     for item_path in selected_items:
-        try:
-            if os.path.isdir(item_path):
-                shutil.rmtree(item_path)
-            else:
-                os.remove(item_path)
-        except Exception as e:
-            error_dialog = create_error_dialog(f"Error deleting {item_path}: {str(e)}")
-            main_loop.widget = error_dialog
-            return
+        changes.remove(item_path)
 
-    selected_items.clear()
-    update_directory(0, LEFT_PANE_PATH)
-    update_directory(1, RIGHT_PANE_PATH)
-    main_loop.widget = columns
+    clear_selected_items()
+    apply_changes(changes)
+    # Items that could not be renamed are still at their original path;
+    # there is nothing to undo, so they go right away.
+    in_place = {path: None for path, original in originals.items() if original is None}
+    trashed = {path: original for path, original in originals.items() if original is not None}
+    if in_place:
+        schedule_purge(PurgeJob(in_place), 0)
+    if trashed:
+        schedule_purge(PurgeJob(trashed))
+    main_loop.widget = frame
 
 def on_cancel_delete(button=None):
-    main_loop.widget = columns
+    main_loop.widget = frame
 
+@instrumented("action.menu")
 def on_action_select(action):
-    global selected_items
     current_path = LEFT_PANE_PATH if current_focus == 0 else RIGHT_PANE_PATH
 
     if action == "Open in Terminal":
@@ -323,39 +3233,113 @@ def on_action_select(action):
         raise urwid.ExitMainLoop()
     elif action == "Open in Nvim":
         if selected_items:
-            item_path = list(selected_items)[0]
+            item_path = next(iter(selected_items))
             subprocess.Popen(['nvim', item_path])
     elif action == "Select/Deselect All":
         toggle_select_all(current_focus)
-    
-    main_loop.widget = columns
+    elif action == "Find Duplicates":
+        transfer_queue.submit(DuplicateJob(current_path))
+    elif action == "Input Statistics":
+        main_loop.widget = create_stats_dialog()
+        return
 
-def toggle_select_all(pane):
-    global selected_items
-    listbox = left_listbox if pane == 0 else right_listbox
-    current_path = LEFT_PANE_PATH if pane == 0 else RIGHT_PANE_PATH
+    main_loop.widget = frame
 
-    all_items = set(os.path.join(current_path, item.base_widget.text.split(' ', 1)[-1].strip())
-                    for item in listbox.body)
+def create_stats_dialog():
+    text = urwid.Text(
+        f"Keys read: {loop_counters['keys']}\n"
+        f"Keys coalesced: {loop_counters['coalesced_keys']}\n"
+        f"Redraws: {loop_counters['redraws']}\n"
+        f"Redraws skipped: {loop_counters['skipped_redraws']}\n"
+        f"Frame rate cap: {MAX_FPS:g}/s"
+    )
+    ok_button = urwid.Button("OK", on_press=lambda _: setattr(main_loop, 'widget', frame))
+    dialog = NavigableDialog([text, urwid.Divider(), urwid.AttrMap(ok_button, None, focus_map='reversed')])
+    return urwid.Overlay(
+        urwid.LineBox(dialog, title="Input Statistics"),
+        frame,
+        align='center',
+        valign='middle',
+        width=('relative', 40),
+        height=('relative', 40),
+        min_width=20,
+        min_height=9
+    )
 
-    if all_items.issubset(selected_items):
-        selected_items -= all_items
+def toggle_select_all(pane):
+    walker = (left_listbox if pane == 0 else right_listbox).body
+    names = walker.names()
+    if walker.directory is None or not names:
+        return
+    if len(selected_items.names(walker.directory)) >= len(names) and \
+            selected_items.names(walker.directory).issuperset(names):
+        selected_items.discard_names(walker.directory, names)
     else:
-        selected_items |= all_items
+        selected_items.add_names(walker.directory, names)
 
-    for i, item in enumerate(listbox.body):
-        item_path = os.path.join(current_path, item.base_widget.text.split(' ', 1)[-1].strip())
-        is_folder = item.base_widget.text.startswith(FOLDER_SYMBOL) or item.base_widget.text.startswith(f"* {FOLDER_SYMBOL}")
-        
-        if item_path in selected_items:
-            prefix = f"* {FOLDER_SYMBOL}" if is_folder else "*   "
+    # Only rows that are actually drawn get rebuilt.
+    walker.refresh()
+
+def compile_selection_rules(text):
+    # Space separated rules that must all match: a glob on the name,
+    # re:REGEX searched in the name, size<10M / size>=1G (folders only once
+    # their size is known), and mtime<2d / mtime>1w for the time since the
+    # last modification.
+    comparisons = {"<": operator.lt, ">": operator.gt, "<=": operator.le, ">=": operator.ge}
+    # A younger age is a later mtime.
+    age_comparisons = {"<": operator.gt, ">": operator.lt, "<=": operator.ge, ">=": operator.le}
+    name_rules = []
+    entry_rules = []
+    for rule in text.split():
+        match = SELECTION_RULE.match(rule)
+        if match:
+            field, op, number, unit = match.groups()
+            units = SIZE_UNITS if field == "size" else AGE_UNITS
+            if unit.lower() not in units or (field == "mtime" and unit == "M"):
+                raise ValueError(f"unknown unit in {rule}")
+            limit = float(number) * units[unit.lower()]
+            if field == "size":
+                entry_rules.append(lambda entry, compare=comparisons[op], limit=limit:
+                                   entry.size is not None and compare(entry.size, limit))
+            else:
+                entry_rules.append(lambda entry, compare=age_comparisons[op], limit=time.time() - limit:
+                                   compare(entry.mtime, limit))
+        elif rule.startswith(("size", "mtime")) and rule.lstrip("sizemtime")[:1] in ("<", ">"):
+            raise ValueError(f"invalid rule {rule}")
+        elif rule.startswith("re:"):
+            try:
+                name_rules.append(re.compile(rule[3:]).search)
+            except re.error as e:
+                raise ValueError(f"invalid regex {rule[3:]}: {e}")
         else:
-            prefix = f"{FOLDER_SYMBOL} " if is_folder else "  "
-        
-        new_text = f"{prefix} {os.path.basename(item_path)}"
-        item.original_widget.set_text(new_text)
-        item._attr_map = {None: 'selected' if item_path in selected_items else None}
-        item._focus_map = {None: 'selected_focus' if item_path in selected_items else 'reversed'}
+            name_rules.append(re.compile(fnmatch.translate(rule)).match)
+    if not name_rules and not entry_rules:
+        raise ValueError("no rules given")
+    return name_rules, entry_rules
+
+def select_matching(pane, text, select=True):
+    # Name rules run first through filter(), so the common glob-only case
+    # never calls back into Python per entry; stat rules only see what the
+    # names let through.
+    walker = (left_listbox if pane == 0 else right_listbox).body
+    name_rules, entry_rules = compile_selection_rules(text)
+    if walker.directory is None:
+        return 0
+    names = walker.names()
+    for rule in name_rules:
+        names = list(filter(rule, names))
+    if entry_rules:
+        by_name = walker.names()
+        entries = [by_name[name] for name in names] if name_rules else walker.entries
+        for rule in entry_rules:
+            entries = list(filter(rule, entries))
+        names = [entry.name for entry in entries]
+    if select:
+        selected_items.add_names(walker.directory, names)
+    else:
+        selected_items.discard_names(walker.directory, names)
+    walker.refresh()
+    return len(names)
 
 def update_focus(pane, direction):
     listbox = left_listbox if pane == 0 else right_listbox
@@ -363,55 +3347,392 @@ def update_focus(pane, direction):
     focus_widget, focus_position = body.get_focus()
     
     if focus_position is not None:
-        new_position = max(0, min(len(body.contents) - 1, focus_position + direction))
+        new_position = max(0, min(len(body) - 1, focus_position + direction))
         body.set_focus(new_position)
         body.set_focus(new_position)
 
-def update_directory(pane, new_path):
+class PaneListBox(urwid.ListBox):
+    def set_entries(self, entries, key=None):
+        # A focus change still pending from before the swap would point into
+        # the old listing.
+        self.set_focus_pending = None
+        self.set_focus_valign_pending = None
+        self.body.set_entries(entries, key)
+
+    def restore(self, snapshot):
+        self.set_focus_pending = None
+        self.set_focus_valign_pending = None
+        self.body.restore(snapshot)
+
+def call_in_main_loop(func, *args):
+    main_loop_calls.put((func, args))
+    if wakeup_fd is not None:
+        try:
+            os.write(wakeup_fd, b"x")
+        except OSError:
+            pass
+
+def run_main_loop_calls(data=None):
+    while True:
+        try:
+            func, args = main_loop_calls.get_nowait()
+        except queue.Empty:
+            break
+        func(*args)
+
+class DirectoryLoader(threading.Thread):
+    def __init__(self, pane, path, cached=None):
+        super().__init__(daemon=True)
+        self.pane = pane
+        self.path = path
+        self.cached = cached
+        self.key = None
+        self.cancelled = False
+        self.created = time.perf_counter()
+        self.first_batch = True
+
+    def run(self):
+        if is_virtual(self.path):
+            # The archive index is the cache; listings are not kept.
+            try:
+                batch = list_archive(self.path)
+            except Exception as e:
+                batch = [Entry(f"Cannot open archive: {e}", os.path.join(self.path, "error"), False)]
+            if not self.cancelled:
+                call_in_main_loop(on_directory_batch, self, batch, True)
+            return
+        try:
+            self.key = directory_key(os.stat(self.path))
+        except OSError:
+            self.key = None
+        if self.cached is not None and self.key is not None and self.cached[0] == self.key:
+            call_in_main_loop(on_directory_cached, self, self.cached[1])
+            return
+
+        with timed("listing.scan"):
+            for batch in scan_directory(self.path):
+                if self.cancelled:
+                    return
+                call_in_main_loop(on_directory_batch, self, batch, False)
+        call_in_main_loop(on_directory_batch, self, [], True)
+
+def on_directory_batch(loader, batch, done):
+    if directory_loaders[loader.pane] is not loader:
+        return
+
+    listbox = left_listbox if loader.pane == 0 else right_listbox
+    pane_box = left_pane if loader.pane == 0 else right_pane
+    if batch:
+        if loader.first_batch and instrument is not None:
+            instrument.record("listing.first_batch_latency", time.perf_counter() - loader.created)
+        loader.first_batch = False
+        with timed("listing.apply_batch"):
+            listbox.body.add_entries(batch)
+        apply_pending_focus(loader.pane)
+    if done:
+        if instrument is not None:
+            instrument.record("listing.total", time.perf_counter() - loader.created)
+        directory_loaders[loader.pane] = None
+        pending_focus[loader.pane] = None
+        pane_box.set_title(pane_title(loader.pane, loader.path))
+        listbox.body.key = loader.key
+        listing_cache.put(loader.path, loader.key, listbox.body.entries)
+    else:
+        pane_box.set_title(f"{pane_title(loader.pane, loader.path)}{LOADING_SUFFIX} {len(listbox.body)}")
+
+def on_directory_cached(loader, entries):
+    if directory_loaders[loader.pane] is not loader:
+        return
+
+    directory_loaders[loader.pane] = None
+    listbox = left_listbox if loader.pane == 0 else right_listbox
+    pane_box = left_pane if loader.pane == 0 else right_pane
+    listbox.set_entries(list(entries), loader.key)
+    apply_pending_focus(loader.pane)
+    pending_focus[loader.pane] = None
+    pane_box.set_title(pane_title(loader.pane, loader.path))
+
+def apply_pending_focus(pane):
+    name = pending_focus[pane]
+    if name is None:
+        return
+    walker = (left_listbox if pane == 0 else right_listbox).body
+    entry = walker.focused_entry()
+    if entry is not None and entry.name == name:
+        pending_focus[pane] = None
+        return
+    i = walker.find(name)
+    if i is not None:
+        walker.set_focus(i)
+        pending_focus[pane] = None
+
+def apply_changes(changes):
+    for pane in (0, 1):
+        listbox = left_listbox if pane == 0 else right_listbox
+        pane_path = os.path.normpath(LEFT_PANE_PATH if pane == 0 else RIGHT_PANE_PATH)
+        removed = changes.removed.get(pane_path, ())
+        added = changes.added.get(pane_path, ())
+        if not removed and not added:
+            continue
+        if directory_loaders[pane] is not None:
+            update_directory(pane, LEFT_PANE_PATH if pane == 0 else RIGHT_PANE_PATH)
+            continue
+
+        walker = listbox.body
+        focused = walker.entries[walker.focus].path if walker.entries else None
+        follow = changes.renamed.get(os.path.normpath(focused)) if focused else None
+        for name in removed:
+            walker.remove_entry(name)
+        for name in sorted(added):
+            entry = make_entry(os.path.join(pane_path, name))
+            if entry is not None:
+                i = walker.insert_entry(entry)
+                if follow == os.path.normpath(entry.path):
+                    walker.set_focus(i)
+
+    for path in changes.directories():
+        listing_cache.invalidate(path)
+
+def toggle_watch_mode():
+    # Keeps both panes live: changes to their directories are collected from
+    # a separate inotify instance and applied as row inserts and removes.
+    global pane_watcher, watch_handle, watch_alarm, watch_overflow
+    if pane_watcher is not None:
+        main_loop.remove_watch_file(watch_handle)
+        if watch_alarm is not None:
+            main_loop.remove_alarm(watch_alarm)
+        pane_watcher.close()
+        pane_watcher = watch_handle = watch_alarm = None
+        watch_overflow = False
+        watch_changes.clear()
+    else:
+        pane_watcher = open_inotify()
+        if pane_watcher is None:
+            main_loop.widget = create_error_dialog("Watching needs inotify, which is not available here.")
+            return
+        watch_handle = main_loop.watch_file(pane_watcher.fd, process_watch_events)
+        watch_pane_paths()
+    for pane in (0, 1):
+        update_pane_title(pane)
+
+def watch_pane_paths():
+    if pane_watcher is None:
+        return
+    paths = {os.path.normpath(path) for path in (LEFT_PANE_PATH, RIGHT_PANE_PATH) if not is_virtual(path)}
+    for path in list(pane_watcher.watches):
+        if path not in paths:
+            pane_watcher.unwatch(path)
+            watch_changes.pop(path, None)
+    for path in paths:
+        pane_watcher.watch(path, INOTIFY_WATCH_MASK)
+
+def process_watch_events(data=None):
+    global watch_alarm, watch_overflow
+    with timed("watch.read"):
+        for path, mask, name in pane_watcher.read_events():
+            if mask & IN_Q_OVERFLOW:
+                watch_overflow = True
+            elif path is not None and name:
+                watch_changes.setdefault(path, set()).add(name)
+    # The window starts at the first event and is not pushed back by later
+    # ones, so a directory that never goes quiet still updates every
+    # WATCH_INTERVAL.
+    if (watch_changes or watch_overflow) and watch_alarm is None:
+        watch_alarm = main_loop.set_alarm_in(WATCH_INTERVAL, apply_watch_changes)
+
+def apply_watch_changes(loop=None, data=None):
+    global watch_alarm, watch_overflow
+    watch_alarm = None
+    paths = [os.path.normpath(LEFT_PANE_PATH), os.path.normpath(RIGHT_PANE_PATH)]
+    if watch_overflow:
+        # The kernel dropped events; only a fresh listing is reliable.
+        watch_overflow = False
+        watch_changes.clear()
+        for pane in (0, 1):
+            if directory_loaders[pane] is None:
+                update_directory(pane, LEFT_PANE_PATH if pane == 0 else RIGHT_PANE_PATH, record=False)
+        return
+    # A pane still loading keeps its changes until the listing is in.
+    loading = {paths[pane] for pane in (0, 1) if directory_loaders[pane] is not None}
+    ready = {path: watch_changes.pop(path) for path in list(watch_changes) if path not in loading}
+    for pane in (0, 1):
+        names = ready.get(paths[pane])
+        if names:
+            with timed("watch.apply"):
+                apply_watched_names(pane, paths[pane], names)
+    if watch_changes:
+        watch_alarm = main_loop.set_alarm_in(WATCH_INTERVAL, apply_watch_changes)
+
+def apply_watched_names(pane, path, names):
+    # One lstat per changed name decides whether its row goes, comes or is
+    # replaced; the rest of the listing is left alone.
+    walker = (left_listbox if pane == 0 else right_listbox).body
+    index = walker.names()
+    gone = []
+    current = []
+    for name in names:
+        entry = make_entry(os.path.join(path, name))
+        if entry is None:
+            if name in index:
+                gone.append(name)
+            continue
+        old = index.get(name)
+        if old is not None and entry.is_dir and old.is_dir:
+            entry.size = old.size
+        current.append(entry)
+    if gone:
+        selected_items.discard_names(path, gone)
+    if gone or current:
+        walker.update_entries(gone, current)
+
+class DirectorySnapshot:
+    __slots__ = ("key", "entries", "names", "sort_mode", "reverse", "focus")
+
+    def __init__(self, key, entries, names, sort_mode, reverse, focus):
+        self.key = key
+        self.entries = entries
+        self.names = names
+        self.sort_mode = sort_mode
+        self.reverse = reverse
+        self.focus = focus
+
+def leave_directory(pane, new_path):
+    # Keeps the sorted listing and cursor of the directory being left, so
+    # going back to it skips listing, sorting and indexing names. Snapshots
+    # are bounded by count and total entries, oldest evicted first; the row
+    # name under the cursor is remembered for longer.
+    walker = (left_listbox if pane == 0 else right_listbox).body
+    if walker.directory is None:
+        return
+    name = pending_focus[pane]
+    if name is None and directory_loaders[pane] is None:
+        entry = walker.focused_entry()
+        name = entry.name if entry is not None else None
+    if name is not None:
+        focus_memory[walker.directory] = name
+        focus_memory.move_to_end(walker.directory)
+        while len(focus_memory) > FOCUS_MEMORY_SIZE:
+            focus_memory.popitem(last=False)
+
+    if directory_loaders[pane] is not None or walker.key is None or not walker.entries:
+        return
+    if walker.directory == os.path.normpath(new_path):
+        # Reloading the same directory should read it again.
+        return
+    drop_snapshot(walker.directory)
+    snapshots[walker.directory] = walker.snapshot()
+    snapshot_entries[0] += len(walker.entries)
+    while snapshots and (len(snapshots) > SNAPSHOT_DIRS or snapshot_entries[0] > SNAPSHOT_MAX_ENTRIES):
+        drop_snapshot(next(iter(snapshots)))
+
+def drop_snapshot(directory):
+    snapshot = snapshots.pop(directory, None)
+    if snapshot is not None:
+        snapshot_entries[0] -= len(snapshot.entries)
+    return snapshot
+
+def take_snapshot(path):
+    # With inotify, valid only while the directory is still watched with no
+    # event since: a write to a file in it does not move its mtime. Without
+    # inotify, valid while its (dev, inode, mtime) is unchanged.
+    snapshot = drop_snapshot(os.path.normpath(path))
+    if snapshot is None:
+        return None
+    if listing_cache.inotify is not None:
+        listing = listing_cache.get(path) if listing_cache.is_watched(path) else None
+        return snapshot if listing is not None and listing[0] == snapshot.key else None
+    try:
+        if directory_key(os.stat(path)) == snapshot.key:
+            return snapshot
+    except OSError:
+        pass
+    return None
+
+def record_history(pane, path):
+    history = pane_history[pane]
+    index = history_index[pane]
+    if index >= 0 and history[index] == path:
+        return
+    del history[index + 1:]
+    history.append(path)
+    if len(history) > HISTORY_SIZE:
+        del history[0]
+    history_index[pane] = len(history) - 1
+
+def go_history(pane, step):
+    # Recently left directories come back from their snapshot; older ones
+    # from listing_cache or a fresh listing.
+    index = history_index[pane] + step
+    if 0 <= index < len(pane_history[pane]):
+        history_index[pane] = index
+        update_directory(pane, pane_history[pane][index], record=False)
+
+def update_directory(pane, new_path, focus_name=None, record=True):
     global LEFT_PANE_PATH, RIGHT_PANE_PATH, left_listbox, right_listbox, left_pane, right_pane
+    leave_directory(pane, new_path)
+    if focus_name is None:
+        focus_name = focus_memory.get(os.path.normpath(new_path))
+    if record:
+        record_history(pane, new_path)
+    with timed("update_directory.cancel"):
+        loader = directory_loaders[pane]
+        if loader is not None:
+            loader.cancelled = True
+            directory_loaders[pane] = None
+        pending_focus[pane] = focus_name
+        if size_jobs[pane] is not None:
+            size_jobs[pane].cancelled = True
+            size_jobs[pane] = None
+
+    if listing_cache.inotify is not None:
+        with timed("update_directory.inotify"):
+            process_inotify_events()
+    with timed("update_directory.cache_lookup"):
+        cached = listing_cache.get(new_path)
+    listbox = left_listbox if pane == 0 else right_listbox
+    pane_box = left_pane if pane == 0 else right_pane
+    listbox.body.directory = os.path.normpath(new_path)
     if pane == 0:
         LEFT_PANE_PATH = new_path
-        paths = get_directory_contents(LEFT_PANE_PATH)
-        left_listbox.body[:] = paths
-        left_pane.set_title(f"{shorten_path(LEFT_PANE_PATH)}")
     else:
         RIGHT_PANE_PATH = new_path
-        paths = get_directory_contents(RIGHT_PANE_PATH)
-        right_listbox.body[:] = paths
-        right_pane.set_title(f"{shorten_path(RIGHT_PANE_PATH)}")
-    
-    if paths:
-        if pane == 0:
-            left_listbox.focus_position = 0
-        else:
-            right_listbox.focus_position = 0
+    watch_pane_paths()
+
+    snapshot = take_snapshot(new_path)
+    if snapshot is not None:
+        with timed("update_directory.restore"):
+            listbox.restore(snapshot)
+        apply_pending_focus(pane)
+        pending_focus[pane] = None
+        pane_box.set_title(pane_title(pane, new_path))
+        return
+
+    if cached is not None and listing_cache.is_watched(new_path):
+        with timed("update_directory.set_entries"):
+            listbox.set_entries(list(cached[1]), cached[0])
+        apply_pending_focus(pane)
+        pending_focus[pane] = None
+        pane_box.set_title(pane_title(pane, new_path))
+        return
+
+    listbox.set_entries([])
+    pane_box.set_title(f"{pane_title(pane, new_path)}{LOADING_SUFFIX}")
+
+    with timed("update_directory.start_loader"):
+        loader = DirectoryLoader(pane, new_path, cached)
+        directory_loaders[pane] = loader
+        loader.start()
 
 def toggle_selection(pane):
-    listbox = left_listbox if pane == 0 else right_listbox
-    current_path = LEFT_PANE_PATH if pane == 0 else RIGHT_PANE_PATH
-    focus_widget, focus_position = listbox.body.get_focus()
-    if focus_widget and focus_position is not None:
-        full_text = focus_widget.base_widget.text
-        is_folder = full_text.startswith(FOLDER_SYMBOL) or full_text.startswith(f"* {FOLDER_SYMBOL}")
-        
-        if is_folder:
-            item_name = full_text.split(' ', 2)[-1].strip()
-        else:
-            item_name = full_text.split(' ', 1)[-1].strip()
-        
-        item_path = os.path.join(current_path, item_name)
-        
-        if item_path in selected_items:
-            selected_items.remove(item_path)
-            prefix = f"{FOLDER_SYMBOL} " if is_folder else "  "
-        else:
-            selected_items.add(item_path)
-            prefix = f"* {FOLDER_SYMBOL}" if is_folder else "*   "
-        
-        new_text = f"{prefix} {item_name}"
-        focus_widget.original_widget.set_text(new_text)
-        focus_widget._attr_map = {None: 'selected' if item_path in selected_items else None}
-        focus_widget._focus_map = {None: 'selected_focus' if item_path in selected_items else 'reversed'}
+    walker = (left_listbox if pane == 0 else right_listbox).body
+    entry = walker.focused_entry()
+    if entry is None or walker.directory is None:
+        return
+    if entry.name in selected_items.names(walker.directory):
+        selected_items.discard_names(walker.directory, (entry.name,))
+    else:
+        selected_items.add_names(walker.directory, (entry.name,))
+    walker.refresh_position(walker.focus)
 
 class NavigableDialog(urwid.WidgetWrap):
     def __init__(self, body):
@@ -434,7 +3755,7 @@ class NavigableDialog(urwid.WidgetWrap):
         return key
 
     def cancel_action(self):
-        main_loop.widget = columns
+        main_loop.widget = frame
 
 class AddDialog(urwid.WidgetWrap):
     def __init__(self):
@@ -457,7 +3778,7 @@ class AddDialog(urwid.WidgetWrap):
         on_add_confirm(self.edit.edit_text)
 
     def on_cancel(self, button):
-        main_loop.widget = columns
+        main_loop.widget = frame
 
     def keypress(self, size, key):
         if key == 'enter':
@@ -468,6 +3789,17 @@ class AddDialog(urwid.WidgetWrap):
             return None
         return super().keypress(size, key)
 
+class PatternDialog(AddDialog):
+    def __init__(self, select):
+        self.select = select
+        super().__init__()
+        verb = "Select" if select else "Deselect"
+        self.edit.set_caption(f"{verb} matching (*.py re:^a size>1M mtime<2d): ")
+        self._w.set_title(f"{verb} by Pattern")
+
+    def on_ok(self, button):
+        on_pattern_confirm(self.edit.edit_text, self.select)
+
 class RenameDialog(NavigableDialog):
     def __init__(self, old_name):
         self.edit = urwid.Edit("Enter new name: ", edit_text=old_name)
@@ -482,10 +3814,109 @@ class RenameDialog(NavigableDialog):
     def confirm_action(self):
         on_rename_confirm(self.edit.get_edit_text())
 
+class FinderDialog(urwid.WidgetWrap):
+    def __init__(self):
+        self.edit = urwid.Edit("/")
+        self.results = urwid.SimpleFocusListWalker([])
+        self.status = urwid.Text("")
+        urwid.connect_signal(self.edit, 'change', self.on_change)
+        pile = urwid.Pile([
+            ('pack', self.edit),
+            ('pack', urwid.Divider()),
+            urwid.ListBox(self.results),
+            ('pack', self.status),
+        ])
+        super().__init__(urwid.LineBox(pile, title="Go to File"))
+        self.update_results()
+
+    def on_change(self, edit, text):
+        self.update_results(text)
+
+    def update_results(self, query=None):
+        global finder_worker, finder_request
+        if query is None:
+            query = self.edit.edit_text
+        if finder_worker is None:
+            finder_worker = FinderWorker()
+            finder_worker.start()
+        finder_request = (file_index, query)
+        finder_worker.submit(finder_request)
+
+    def show_results(self, paths):
+        self.results[:] = [urwid.AttrMap(urwid.Text(path, wrap='clip'), None, focus_map='reversed')
+                           for path in paths]
+        if paths:
+            self.results.set_focus(0)
+        state = " indexing…" if file_index.crawling else ""
+        self.status.set_text(f"{len(paths)} shown, {file_index.paths[2]} indexed{state}")
+
+    def keypress(self, size, key):
+        if key == 'esc':
+            main_loop.widget = frame
+            return None
+        elif key == 'enter':
+            focus_widget, _ = self.results.get_focus()
+            if focus_widget is not None:
+                on_finder_choose(focus_widget.original_widget.text)
+            return None
+        elif key in ('down', 'ctrl n'):
+            focus = self.results.focus
+            if focus is not None and focus + 1 < len(self.results):
+                self.results.set_focus(focus + 1)
+            return None
+        elif key in ('up', 'ctrl p'):
+            focus = self.results.focus
+            if focus:
+                self.results.set_focus(focus - 1)
+            return None
+        return self.edit.keypress((size[0] - 2,), key)
+
+def create_finder_dialog():
+    start_file_index()
+    return urwid.Overlay(
+        FinderDialog(),
+        frame,
+        align='center',
+        valign='middle',
+        width=('relative', 80),
+        height=('relative', 70),
+        min_width=20,
+        min_height=8
+    )
+
+@instrumented("action.finder")
+def on_finder_choose(path):
+    main_loop.widget = frame
+    if path.endswith("/"):
+        update_directory(current_focus, path.rstrip("/") or "/")
+    else:
+        update_directory(current_focus, os.path.dirname(path), os.path.basename(path))
+
+def create_pattern_dialog(select):
+    return urwid.Overlay(
+        PatternDialog(select),
+        frame,
+        align='center',
+        valign='middle',
+        width=('relative', 60),
+        height=('relative', 30),
+        min_width=20,
+        min_height=5
+    )
+
+@instrumented("action.select_pattern")
+def on_pattern_confirm(text, select):
+    try:
+        select_matching(current_focus, text, select)
+    except ValueError as e:
+        main_loop.widget = create_error_dialog(str(e))
+        return
+    main_loop.widget = frame
+
 def create_add_dialog():
     return urwid.Overlay(
         AddDialog(),
-        columns,
+        frame,
         align='center',
         valign='middle',
         width=('relative', 50),
@@ -494,10 +3925,23 @@ def create_add_dialog():
         min_height=5
     )
 
+@instrumented("action.add")
 def on_add_confirm(name):
     current_path = LEFT_PANE_PATH if current_focus == 0 else RIGHT_PANE_PATH
+    if is_virtual(current_path):
+        main_loop.widget = create_error_dialog("Archives are read-only.")
+        return
     new_path = os.path.join(current_path, name)
-    
+    changes = DirectoryChanges()
+
+    created = os.path.normpath(new_path)
+    while not os.path.lexists(created):
+        changes.add(created)
+        parent = os.path.dirname(created)
+        if parent == created:
+            break
+        created = parent
+
     try:
         if name.endswith('/'):
             os.makedirs(new_path, exist_ok=True)
@@ -505,29 +3949,40 @@ def on_add_confirm(name):
             os.makedirs(os.path.dirname(new_path), exist_ok=True)
             open(new_path, 'a').close()
         
-        update_directory(current_focus, current_path)
+        apply_changes(changes)
     except OSError as e:
+        apply_changes(changes)
         error_dialog = create_error_dialog(f"Error creating {name}: {str(e)}")
         main_loop.widget = error_dialog
         return
 
-    main_loop.widget = columns
+    main_loop.widget = frame
 
+@instrumented("action.rename")
 def on_rename_confirm(new_name):
-    focus_widget, _ = (left_listbox if current_focus == 0 else right_listbox).body.get_focus()
-    old_name = focus_widget.base_widget.text.split(' ', 1)[-1].strip()
-    current_path = LEFT_PANE_PATH if current_focus == 0 else RIGHT_PANE_PATH
-    old_path = os.path.join(current_path, old_name)
-    new_path = os.path.join(current_path, new_name)
+    entry = (left_listbox if current_focus == 0 else right_listbox).body.focused_entry()
+    if entry is None:
+        main_loop.widget = frame
+        return
+    old_path = entry.path
+    if is_virtual(os.path.dirname(old_path)):
+        main_loop.widget = create_error_dialog("Archives are read-only.")
+        return
+    new_path = os.path.join(os.path.dirname(old_path), new_name)
     
+    changes = DirectoryChanges()
     os.rename(old_path, new_path)
-    update_directory(current_focus, current_path)
-    main_loop.widget = columns
+    changes.rename(old_path, new_path)
+    apply_changes(changes)
+    main_loop.widget = frame
 
 def maintain_focus_position(from_pane, to_pane):
     from_listbox = left_listbox if from_pane == 0 else right_listbox
     to_listbox = right_listbox if from_pane == 0 else left_listbox
     
+    if not len(from_listbox.body) or not len(to_listbox.body):
+        return
+
     current_position = from_listbox.focus_position
     max_position = len(to_listbox.body) - 1
     
@@ -536,6 +3991,12 @@ def maintain_focus_position(from_pane, to_pane):
     else:
         to_listbox.focus_position = current_position
 
+def dispatch_input(key):
+    # Mouse events are tuples with coordinates in them; one histogram each
+    # would grow without bound.
+    with timed(f"input.{key}" if isinstance(key, str) else "input.other"):
+        return handle_input(key)
+
 def handle_input(key):
     global current_focus, LAST_KEY
 
@@ -544,21 +4005,23 @@ def handle_input(key):
 
     elif key == 'c':
         if selected_items:
-            main_loop.widget = create_copy_move_dialog("copy")
+            start_transfer_plan("copy")
 
     elif key == 'm':
         if selected_items:
-            main_loop.widget = create_copy_move_dialog("move")
+            start_transfer_plan("move")
 
     elif key == 'g':
         if LAST_KEY == 'g':
             listbox = left_listbox if current_focus == 0 else right_listbox
-            listbox.focus_position = 0
+            if len(listbox.body):
+                listbox.focus_position = 0
             LAST_KEY = None
 
     elif key == 'G':
         listbox = left_listbox if current_focus == 0 else right_listbox
-        listbox.focus_position = len(listbox.body) - 1
+        if len(listbox.body):
+            listbox.focus_position = len(listbox.body) - 1
 
 
     elif key == '0':
@@ -587,6 +4050,15 @@ def handle_input(key):
     elif key == 'd':
         main_loop.widget = create_delete_dialog()
 
+    elif key == 'x':
+        cancel_transfer()
+
+    elif key == 'P':
+        toggle_pause_transfer()
+
+    elif key == 'u':
+        undo_delete()
+
     elif key == 'o':
         main_loop.widget = create_action_dialog()
 
@@ -600,19 +4072,24 @@ def handle_input(key):
 
     elif key == 'enter':
         listbox = left_listbox if current_focus == 0 else right_listbox
-        current_path = LEFT_PANE_PATH if current_focus == 0 else RIGHT_PANE_PATH
-        focus_widget, focus_position = listbox.body.get_focus()
-        if focus_widget and focus_position is not None:
-            item_name = focus_widget.base_widget.text.split(' ', 1)[-1].strip()
-            new_path = os.path.join(current_path, item_name)
-            if os.path.isdir(new_path):
-                update_directory(current_focus, new_path)
+        entry = listbox.body.focused_entry()
+        if entry is not None and (entry.is_dir or ARCHIVE_NAME.search(entry.name)):
+            update_directory(current_focus, entry.path)
 
     elif key == 'backspace':
         current_path = LEFT_PANE_PATH if current_focus == 0 else RIGHT_PANE_PATH
         parent_path = os.path.dirname(current_path)
         if parent_path != current_path:
-            update_directory(current_focus, parent_path)
+            update_directory(current_focus, parent_path, os.path.basename(current_path))
+
+    elif key == 'w':
+        toggle_watch_mode()
+
+    elif key == 'H':
+        go_history(current_focus, -1)
+
+    elif key == 'L':
+        go_history(current_focus, 1)
 
     elif key == ' ':
         toggle_selection(current_focus)
@@ -620,46 +4097,391 @@ def handle_input(key):
     elif key == 'a':
         main_loop.widget = create_add_dialog()
 
+    elif key in ('+', '-'):
+        main_loop.widget = create_pattern_dialog(key == '+')
+
+    elif key == '/':
+        main_loop.widget = create_finder_dialog()
+
+    elif key == 'S':
+        start_folder_sizes(current_focus)
+
+    elif key == 's':
+        cycle_sort_mode(current_focus)
+
+    elif key == 'R':
+        walker = (left_listbox if current_focus == 0 else right_listbox).body
+        set_sort_mode(current_focus, walker.sort_mode, not walker.reverse)
+
     elif key == 'r':
-        focus_widget, _ = (left_listbox if current_focus == 0 else right_listbox).body.get_focus()
-        old_name = focus_widget.base_widget.text.split(' ', 1)[-1].strip()
-        main_loop.widget = urwid.Overlay(RenameDialog(old_name), columns, align='center', valign='middle', width=('relative', 40), height=('relative', 20))
+        entry = (left_listbox if current_focus == 0 else right_listbox).body.focused_entry()
+        if entry is None:
+            return
+        main_loop.widget = urwid.Overlay(RenameDialog(entry.name), frame, align='center', valign='middle', width=('relative', 40), height=('relative', 20))
+
+    elif key == 'p':
+        toggle_preview()
+
+    elif key == 'f9':
+        toggle_profiler()
 
     elif key in ('q', 'Q'):
-        raise urwid.ExitMainLoop()
+        request_quit()
 
     LAST_KEY = key
+    schedule_preview()
+
+def coalesce_input(keys, raw):
+    # Held j/k keys pile up in the terminal while a frame is being drawn. A
+    # read that holds nothing but cursor movement becomes one jump.
+    global LAST_KEY
+    loop_counters["keys"] += len(keys)
+    if len(keys) < 2 or main_loop.widget is not frame:
+        return keys
+    if not all(isinstance(key, str) and key in NAVIGATION_KEYS for key in keys):
+        return keys
+    loop_counters["coalesced_keys"] += len(keys) - 1
+    with timed("input.coalesced"):
+        update_focus(current_focus, sum(NAVIGATION_KEYS[key] for key in keys))
+    LAST_KEY = keys[-1]
+    schedule_preview()
+    return []
 
-left_paths = get_directory_contents(LEFT_PANE_PATH)
-right_paths = get_directory_contents(RIGHT_PANE_PATH)
+class ThrottledMainLoop(urwid.MainLoop):
+    # Draws at most MAX_FPS times a second. A skipped draw is retried from
+    # an alarm so the last state always reaches the screen.
+    last_draw = 0.0
+    redraw_alarm = None
 
-left_listbox = urwid.ListBox(urwid.SimpleListWalker(left_paths))
-right_listbox = urwid.ListBox(urwid.SimpleListWalker(right_paths))
+    def draw_screen(self):
+        if MAX_FPS > 0:
+            wait = self.last_draw + 1 / MAX_FPS - time.monotonic()
+            if wait > 0:
+                loop_counters["skipped_redraws"] += 1
+                if self.redraw_alarm is None:
+                    self.redraw_alarm = self.set_alarm_in(wait, self.on_redraw_alarm)
+                return
+        self.last_draw = time.monotonic()
+        loop_counters["redraws"] += 1
+        with timed("render"):
+            super().draw_screen()
+        if deferred_pane is not None:
+            on_startup_paint()
+
+    def on_redraw_alarm(self, loop, data):
+        self.redraw_alarm = None
+        self.draw_screen()
+
+left_listbox = PaneListBox(EntryWalker())
+right_listbox = PaneListBox(EntryWalker())
 
 left_pane = urwid.LineBox(left_listbox, title=f"{shorten_path(LEFT_PANE_PATH)}")
 right_pane = urwid.LineBox(right_listbox, title=f"{shorten_path(RIGHT_PANE_PATH)}")
 
+preview_content = urwid.Text("", wrap='clip')
+preview_box = urwid.LineBox(urwid.Filler(preview_content, valign='top'), title="Preview")
+
 columns = urwid.Columns([left_pane, right_pane])
+status_bar = urwid.Text("")
+frame = urwid.Frame(columns, footer=status_bar)
 
 current_focus = 0
 
-if left_paths:
-    left_listbox.body.set_focus(0)
-if right_paths:
-    right_listbox.body.set_focus(0)
-
 palette = [
     ('reversed', 'standout', ''),
     ('selected', 'white', 'dark blue'),
     ('selected_focus', 'white', 'light blue'),
 ]
 
-main_loop = urwid.MainLoop(columns, unhandled_input=handle_input, palette=palette)
+listing_cache = ListingCache()
+transfer_queue = TransferQueue()
+copy_pool = None
+reflink_unsupported = set()
+trash_dirs = {}
+trash_batches = []
+trash_counter = 0
+status_alarm = None
+file_index = None
+finder_worker = None
+finder_request = None
+size_cache = SizeCache()
+archive_indexes = OrderedDict()
+archive_lock = threading.Lock()
+hash_cache = HashCache()
+preview_worker = None
+preview_alarm = None
+preview_path = None
+preview_request = None
+loop_counters = {"keys": 0, "coalesced_keys": 0, "redraws": 0, "skipped_redraws": 0}
 
-if __name__ == "__main__":
+class BatchError(Exception):
+    pass
+
+def parse_batch_operation(line):
+    try:
+        op = json.loads(line)
+    except ValueError as e:
+        raise BatchError(f"invalid JSON: {e}")
+    if not isinstance(op, dict):
+        raise BatchError("an operation must be a JSON object")
+    if op.get("op") not in BATCH_OPERATIONS:
+        raise BatchError(f"op must be one of {', '.join(BATCH_OPERATIONS)}")
+    items = op.get("items", op.get("src"))
+    if isinstance(items, str):
+        items = [items]
+    if not items or not all(isinstance(item, str) for item in items):
+        raise BatchError("items must be a path or a list of paths")
+    op["items"] = [os.path.abspath(os.path.expanduser(item)) for item in items]
+    if op["op"] != "delete":
+        if not isinstance(op.get("dest"), str):
+            raise BatchError("dest must be a directory")
+        op["dest"] = os.path.abspath(os.path.expanduser(op["dest"]))
+        if not os.path.isdir(op["dest"]):
+            raise BatchError(f"not a directory: {op['dest']}")
+    # Strings such as "no" would otherwise count as true.
+    for flag in ("overwrite", "checksum", "prune", "dry_run"):
+        if not isinstance(op.get(flag, False), bool):
+            raise BatchError(f"{flag} must be true or false")
+    return op
+
+def run_batch_item(op, item, job):
+    if op["op"] == "delete":
+        # Deleted straight away: there is no session to undo from.
+        if not os.path.lexists(item):
+            raise FileNotFoundError(errno.ENOENT, "No such file or directory", item)
+        purge = PurgeJob({item: None})
+        run_purge(purge)
+        purge.close_pool()
+        if purge.error is not None:
+            raise purge.error
+        return None
+    transfer = TRANSFER_FUNCTIONS[(op["op"], bool(op.get("overwrite")))]
+    transfer([item], op["dest"], None, job)
+    return os.path.join(op["dest"], os.path.basename(item))
+
+def run_batch_calls():
+    # Without a main loop nothing runs what the transfer code posts back;
+    # only purging what overwriting moves put in the trash matters here.
+    while True:
+        try:
+            func, args = main_loop_calls.get_nowait()
+        except queue.Empty:
+            break
+        if func is schedule_purge:
+            run_purge(args[0])
+            args[0].close_pool()
+
+def run_batch_operation(number, op, emit):
+    if op.get("dry_run"):
+        plan = PlanJob(op["op"], op["items"], op.get("dest"))
+        plan_transfer(plan)
+        emit({"id": op.get("id", number), "op": op["op"], "status": "planned", **plan.summary()})
+        return 0
+    job = TransferJob(op["op"], op["items"], op.get("dest"), bool(op.get("overwrite")),
+                      checksum=bool(op.get("checksum")), prune=bool(op.get("prune")))
+    job.started = time.monotonic()
+    op_id = op.get("id", number)
+    failed = 0
+    for item in op["items"]:
+        start = time.perf_counter()
+        bytes_done = job.bytes_done
+        result = {"id": op_id, "op": op["op"], "item": item}
+        try:
+            with timed(f"batch.{op['op']}"):
+                dest = run_batch_item(op, item, job)
+            if dest is not None:
+                result["dest"] = dest
+            result["status"] = "ok"
+        except FileExistsError as e:
+            result["status"] = "conflict"
+            result["error"] = str(e)
+        except OSError as e:
+            result["status"] = "error"
+            result["error"] = str(e)
+        finally:
+            run_batch_calls()
+        if result["status"] != "ok":
+            failed += 1
+        result["bytes"] = job.bytes_done - bytes_done
+        result["seconds"] = time.perf_counter() - start
+        emit(result)
+    job.close_pool()
+    summary = {"id": op_id, "op": op["op"], "status": "done", "items": len(op["items"]), "failed": failed,
+               "bytes": job.bytes_done, "seconds": time.monotonic() - job.started}
+    if op["op"] == "sync":
+        summary.update(files_copied=job.files_done, files_unchanged=job.files_skipped,
+                       bytes_saved=job.bytes_skipped, files_removed=job.files_removed)
+    emit(summary)
+    return failed
+
+def run_batch(options):
+    # Runs operations from --op arguments, or one JSON object per stdin
+    # line, through the same copy/move functions as the panes. Operations
+    # run concurrently, the items of one operation in order; every item and
+    # every operation reports a JSON line on stdout.
+    output_lock = threading.Lock()
+    started = time.perf_counter()
+
+    def emit(result):
+        line = json.dumps(result)
+        with output_lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    lines = options.ops if options.ops else sys.stdin
+    futures = []
+    failed = 0
+    with ThreadPoolExecutor(max_workers=options.jobs, thread_name_prefix="fm-batch") as pool:
+        for number, line in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                op = parse_batch_operation(line)
+            except BatchError as e:
+                emit({"id": number, "status": "invalid", "error": str(e)})
+                failed += 1
+                continue
+            if options.dry_run:
+                op["dry_run"] = True
+            futures.append(pool.submit(run_batch_operation, number, op, emit))
+    failed += sum(future.result() for future in futures)
+    emit({"status": "finished", "operations": len(futures), "failed": failed,
+          "seconds": time.perf_counter() - started})
+    return 1 if failed else 0
+
+main_loop = None
+options = None
+deferred_pane = None
+startup_times = {}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="A simple file manager.")
+    parser.add_argument('path', nargs='?', help="Initial path for the left pane (default: the last session).")
+    parser.add_argument('--index-root', action='append', dest='index_roots', metavar='PATH',
+                        help="Directory tree searched by the / finder (repeatable, default: home).")
+    parser.add_argument('--instrument', metavar='FILE',
+                        help="Time listing, input, actions, rendering and transfers and write them to FILE on exit "
+                             "(also enabled by FM_INSTRUMENT=FILE).")
+    parser.add_argument('--startup-time', action='store_true',
+                        help="Exit once the focused pane is painted and print startup timings as JSON.")
+    parser.add_argument('--batch', action='store_true',
+                        help="Run file operations without the UI and report JSON lines on stdout.")
+    parser.add_argument('--op', action='append', dest='ops', metavar='JSON',
+                        help='A --batch operation such as \'{"op": "copy", "items": ["a"], "dest": "b"}\' '
+                             '(repeatable, default: one per line on stdin).')
+    parser.add_argument('--jobs', type=int, default=TRANSFER_WORKERS,
+                        help="Number of --batch operations run at the same time.")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Print each --batch operation's plan (files, bytes, conflicts, estimate) without running it.")
+    options = parser.parse_args(argv)
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return options
+
+def load_session():
+    try:
+        with open(SESSION_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_session():
+    panes = []
+    for pane in (0, 1):
+        if deferred_pane is not None and deferred_pane[0] == pane:
+            panes.append({"path": deferred_pane[1], "focus": deferred_pane[2]})
+            continue
+        entry = (left_listbox if pane == 0 else right_listbox).body.focused_entry()
+        focus = pending_focus[pane] or (entry.name if entry is not None else None)
+        panes.append({"path": LEFT_PANE_PATH if pane == 0 else RIGHT_PANE_PATH, "focus": focus})
+    os.makedirs(os.path.dirname(SESSION_PATH), exist_ok=True)
+    with open(SESSION_PATH, "w") as f:
+        json.dump({"panes": panes, "current_focus": current_focus}, f)
+
+def setup(argv=None, screen=None):
+    # Only the focused pane is listed before the first frame; the other one
+    # is started once that pane has been painted.
+    global options, main_loop, wakeup_fd, current_focus, deferred_pane, LEFT_PANE_PATH, RIGHT_PANE_PATH
+    options = parse_args(argv)
+    instrument_path = options.instrument or os.environ.get("FM_INSTRUMENT")
+    if instrument_path:
+        enable_instrumentation(instrument_path)
+    session = load_session()
+    panes = session.get("panes") or [{}, {}]
+    targets = []
+    for pane in (0, 1):
+        path = panes[pane].get("path")
+        focus = panes[pane].get("focus")
+        if pane == 0 and options.path is not None:
+            path, focus = options.path, None
+        if not path or not os.path.isdir(path):
+            path, focus = DEFAULT_LEFT_PANE_PATH if pane == 0 else DEFAULT_RIGHT_PANE_PATH, None
+        targets.append((pane, path, focus))
+    current_focus = session.get("current_focus", 0) if options.path is None else 0
+    columns.focus_position = current_focus
+    LEFT_PANE_PATH, RIGHT_PANE_PATH = targets[0][1], targets[1][1]
+    left_pane.set_title(shorten_path(LEFT_PANE_PATH))
+    right_pane.set_title(shorten_path(RIGHT_PANE_PATH))
+
+    main_loop = ThrottledMainLoop(frame, screen=screen, unhandled_input=dispatch_input, palette=palette,
+                                  input_filter=coalesce_input)
+    wakeup_fd = main_loop.watch_pipe(run_main_loop_calls)
+    os.set_blocking(wakeup_fd, False)
+    listing_cache.inotify = open_inotify()
+    if listing_cache.inotify is not None:
+        main_loop.watch_file(listing_cache.inotify.fd, process_inotify_events)
+
+    update_directory(*targets[current_focus])
+    deferred_pane = targets[1 - current_focus]
+    startup_times["setup"] = time.perf_counter() - START_TIME
+
+def on_startup_paint():
+    now = time.perf_counter() - START_TIME
+    startup_times.setdefault("first_paint", now)
+    walker = (left_listbox if current_focus == 0 else right_listbox).body
+    if directory_loaders[current_focus] is not None and not len(walker):
+        return
+    startup_times["focused_pane_paint"] = now
+    load_deferred_pane()
+    if options.startup_time:
+        main_loop.set_alarm_in(0, stop_main_loop)
+
+def load_deferred_pane():
+    global deferred_pane
+    if deferred_pane is not None:
+        pane, path, focus = deferred_pane
+        deferred_pane = None
+        update_directory(pane, path, focus)
+
+def stop_main_loop(loop=None, data=None):
+    raise urwid.ExitMainLoop()
+
+def main():
+    batch_options = parse_args()
+    if batch_options.batch:
+        instrument_path = batch_options.instrument or os.environ.get("FM_INSTRUMENT")
+        if instrument_path:
+            enable_instrumentation(instrument_path)
+        try:
+            raise SystemExit(run_batch(batch_options))
+        finally:
+            if instrument is not None:
+                instrument.dump()
+    setup()
     try:
         main_loop.run()
     finally:
+        purge_pending_trash()
+        try:
+            save_session()
+        except OSError:
+            pass
+        if profiler is not None:
+            stop_profiler()
+        if instrument is not None:
+            instrument.dump()
+        if options.startup_time:
+            print(json.dumps({name: round(value * 1000, 2) for name, value in startup_times.items()}))
         last_path_file = os.path.expanduser("~/.last_fm_path")
         if os.path.exists(last_path_file):
             with open(last_path_file, "r") as f:
@@ -667,3 +4489,5 @@ if __name__ == "__main__":
             os.remove(last_path_file)
             os.system(f"cd {last_path} && exec $SHELL")
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import errno
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fm
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+@pytest.fixture
+def cross_device(monkeypatch):
+    # Every rename fails as it would between two filesystems.
+    def rename(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link", src)
+    monkeypatch.setattr(os, "rename", rename)
+
+
+def test_move_across_filesystems_keeps_files_added_after_planning(tmp_path, cross_device):
+    src = tmp_path / "src" / "tree"
+    dest = tmp_path / "dest"
+    write(str(src / "a.txt"), "a")
+    write(str(src / "sub" / "b.txt"), "b")
+    dest.mkdir()
+    plan = fm.PlanJob("move", [str(src)], str(dest))
+    fm.plan_transfer(plan)
+    # Written while the confirm dialog is open.
+    write(str(src / "sub" / "late.txt"), "late")
+
+    job = fm.TransferJob("move", plan.items, str(dest), plan=plan)
+    fm.run_transfer(job)
+
+    assert read(str(dest / "tree" / "a.txt")) == "a"
+    assert read(str(dest / "tree" / "sub" / "b.txt")) == "b"
+    assert read(str(dest / "tree" / "sub" / "late.txt")) == "late"
+    assert not src.exists()
+    assert job.error is None
+
+
+def test_move_across_filesystems_leaves_files_added_during_the_copy(tmp_path, cross_device, monkeypatch):
+    src = tmp_path / "src" / "tree"
+    dest = tmp_path / "dest"
+    write(str(src / "a.txt"), "a")
+    dest.mkdir()
+    copy_node = fm.copy_node
+
+    def copy_and_add(src_path, dst_path, job=None):
+        copy_node(src_path, dst_path, job)
+        write(str(src / "late.txt"), "late")
+    monkeypatch.setattr(fm, "copy_node", copy_and_add)
+
+    job = fm.TransferJob("move", [str(src)], str(dest))
+    fm.run_transfer(job)
+
+    assert read(str(dest / "tree" / "a.txt")) == "a"
+    assert read(str(src / "late.txt")) == "late"
+    assert not (src / "a.txt").exists()
+    assert isinstance(job.error, OSError) and job.error.errno == errno.ENOTEMPTY
+
+
+def test_copy_onto_itself_is_refused(tmp_path):
+    write(str(tmp_path / "thesis.txt"), "chapter one")
+    write(str(tmp_path / "notes" / "todo.txt"), "todo")
+    for name in ("thesis.txt", "notes"):
+        with pytest.raises(shutil.SameFileError):
+            fm.copy_items_force([str(tmp_path / name)], str(tmp_path))
+    assert read(str(tmp_path / "thesis.txt")) == "chapter one"
+    assert read(str(tmp_path / "notes" / "todo.txt")) == "todo"
+
+
+def test_overwriting_move_onto_itself_keeps_the_source(tmp_path):
+    write(str(tmp_path / "thesis.txt"), "chapter one")
+    with pytest.raises(shutil.SameFileError):
+        fm.move_items_force([str(tmp_path / "thesis.txt")], str(tmp_path))
+    assert read(str(tmp_path / "thesis.txt")) == "chapter one"
+
+
+@pytest.mark.parametrize("action", ["copy", "move"])
+def test_plan_reports_items_already_in_the_destination(tmp_path, action):
+    write(str(tmp_path / "src" / "thesis.txt"), "chapter one")
+    write(str(tmp_path / "src" / "other.txt"), "other")
+    items = [str(tmp_path / "src" / "thesis.txt")]
+    plan = fm.PlanJob(action, items, str(tmp_path / "src"))
+    fm.plan_transfer(plan)
+    assert plan.same == items
+    assert plan.summary()["same"] == items